@@ -1,13 +1,109 @@
 import os
 import sys
-from PIL import Image
+import io
+import json
+import argparse
+import hashlib
+import heapq
+import re
+import traceback
+import queue
+import shutil
+import time
+import threading
+from collections import namedtuple
+from contextlib import contextmanager, nullcontext
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from PIL import Image, ImageChops, UnidentifiedImageError
+
+# NumPy is only needed for auto quality (SSIM) and is optional otherwise
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# resource (peak RSS reporting) only exists on Unix
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# fcntl (used for reflink copies) only exists on Unix
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# psutil reads the current RSS for memory measurements where /proc is not available
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+# inotify_simple lets watch mode use inotify on Linux instead of polling
+try:
+    from inotify_simple import INotify, flags as inotify_flags
+except ImportError:
+    INotify = None
+    inotify_flags = None
 
 # Try to register HEIC support if pillow_heif is available
 try:
     import pillow_heif
     pillow_heif.register_heif_opener()
 except ImportError:
-    print("Warning: pillow-heif is not installed. HEIC images will not be supported. To enable HEIC support, run: pip install pillow-heif")
+    # stderr, so it never mixes into the command line's piped output
+    print("Warning: pillow-heif is not installed. HEIC images will not be supported. To enable HEIC support, run: pip install pillow-heif", file=sys.stderr)
+
+# Shrink-on-load factor: the decoder/reduce() step keeps at least this many times
+# the target size before the final LANCZOS resize. Larger values are closer to a
+# full-resolution resize (2.0 differs by well under one level per channel, 3.0+
+# is practically identical) but save less work; None disables shrink-on-load.
+DEFAULT_REDUCING_GAP = 2.0
+
+# Source formats picked up by the scanner (matched case-insensitively)
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".gif", ".bmp", ".heic", ".tiff", ".tif")
+
+# A source file found by scan_images; rel_path is relative to the scanned directory
+ScanItem = namedtuple("ScanItem", ["path", "rel_path", "size", "mtime_ns"])
+
+# Auto quality compares luma planes downsampled to at most this many pixels per side
+SSIM_MAX_SIDE = 512
+
+# Kinds of Event emitted by the pipeline
+EVENT_KINDS = ("run", "scan", "plan", "skip", "decode", "resize", "encode", "write", "delete", "done", "error", "summary")
+
+# ioctl request for a copy-on-write clone of a whole file (Linux, Btrfs/XFS)
+FICLONE = 0x40049409
+
+# Animated sources in these formats become animated WebPs (other formats keep frame 1)
+ANIMATED_FORMATS = ("GIF", "PNG")
+
+# Working memory of the WebP encoder per output pixel (ARGB copy plus YUV planes)
+ENCODE_BYTES_PER_PIXEL = 6
+
+# Rough costs for dry-run plans, in seconds per megapixel on one core (measured
+# with Pillow 11 on photo-like content; flat graphics are cheaper to encode).
+# Decode is per decoded megapixel, resize per megapixel resized from and
+# encode per output megapixel, by WebP method.
+DECODE_SECONDS_PER_MP = {"JPEG": 0.012, "PNG": 0.033, "GIF": 0.02, "TIFF": 0.003, "BMP": 0.003, "HEIF": 0.05}
+DEFAULT_DECODE_SECONDS_PER_MP = 0.02
+RESIZE_SECONDS_PER_MP = 0.025
+ENCODE_SECONDS_PER_MP = {0: 0.035, 1: 0.06, 2: 0.09, 3: 0.12, 4: 0.16, 5: 0.24, 6: 0.34}
+LOSSLESS_ENCODE_SECONDS_PER_MP = 1.5
+
+# EXIF tag holding the orientation (1 = upright)
+EXIF_ORIENTATION = 0x0112
+
+# Incremental mode keeps this manifest in the output root
+MANIFEST_FILENAME = ".opti_webp_manifest.json"
+MANIFEST_VERSION = 1
+
+# Job journal written when resize_and_convert(journal=True), in the output root
+JOURNAL_FILENAME = ".opti_webp_journal.jsonl"
+
+# Run report written per shard, and for the merged run by merge_shards
+REPORT_FILENAME = ".opti_webp_report.json"
 
 def get_icon_path():
     """Get the path to the application icon file."""
@@ -16,111 +112,1697 @@ def get_icon_path():
     else:
         return os.path.join(os.path.dirname(os.path.abspath(__file__)), 'opti_webp.ico')
 
-def count_images(directory, include_subdirs=False):
-    image_count = 0
+def scan_images(directory, include_subdirs=False, on_error=None):
+    """Yield a ScanItem for every optimizable image under directory.
     
-    if include_subdirs:
-        for root, dirs, files in os.walk(directory):
-            for filename in files:
-                if filename.lower().endswith((".png", ".jpg", ".jpeg", ".gif", ".bmp", ".heic", ".tiff", ".tif")):
-                    image_count += 1
-    else:
-        image_count = sum([filename.lower().endswith((".png", ".jpg", ".jpeg", ".gif", ".bmp", ".heic", ".tiff", ".tif")) 
-                          for filename in os.listdir(directory)])
+    Uses a single os.scandir pass (the stat data comes with the directory
+    listing on most platforms) and yields items as they are found, so callers
+    can start working before the scan finishes. Entries that can't be read
+    are passed to on_error(path, exception), or printed if it is None.
+    """
+    pending_dirs = [directory]
+    while pending_dirs:
+        current = pending_dirs.pop()
+        subdirs = []
+        try:
+            with os.scandir(current) as entries:
+                for entry in entries:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            if include_subdirs:
+                                subdirs.append(entry.path)
+                        elif entry.name.lower().endswith(IMAGE_EXTENSIONS) and entry.is_file():
+                            stat = entry.stat()
+                            yield ScanItem(entry.path, os.path.relpath(entry.path, directory),
+                                           stat.st_size, stat.st_mtime_ns)
+                    except OSError as e:
+                        if on_error is None:
+                            print(f"Could not read {entry.path}: {e}")
+                        else:
+                            on_error(entry.path, e)
+        except OSError as e:
+            if on_error is None:
+                print(f"Could not scan directory {current}: {e}")
+            else:
+                on_error(current, e)
+        # Visit subdirectories in listing order
+        pending_dirs.extend(reversed(subdirs))
+
+def iter_in_background(iterable, callback=None):
+    """Consume iterable on a helper thread and yield its items as they arrive.
+    
+    Lets a directory scan run ahead of (slower) processing; callback, if given,
+    is called from the helper thread with the running item count.
+    """
+    items = queue.Queue()
+    done = object()
+    failure = []
+
+    def produce():
+        count = 0
+        try:
+            for item in iterable:
+                count += 1
+                if callback:
+                    callback(count)
+                items.put(item)
+        except BaseException as e:
+            failure.append(e)
+        finally:
+            items.put(done)
+
+    threading.Thread(target=produce, daemon=True).start()
+    while True:
+        item = items.get()
+        if item is done:
+            break
+        yield item
+    if failure:
+        raise failure[0]
+
+def count_images(directory, include_subdirs=False):
+    image_count = sum(1 for _ in scan_images(directory, include_subdirs))
     
     print(f"Optimizable Images found: {image_count}")
     return image_count
 
-def process_image(img_path, max_width, max_height, delete_original=False, custom_output_dir=None, preserve_structure=True, progress_callback=None, base_directory=None, preserve_exif=False):
+def calculate_target_size(width, height, max_width, max_height):
+    """Return the (width, height) to resize to, or None if the image already fits the limits."""
+    # Initialize scaling ratios
+    width_ratio = float('inf')
+    height_ratio = float('inf')
+    
+    # Calculate ratios only for enabled dimensions
+    if max_width:
+        width_ratio = max_width / width
+    if max_height:
+        height_ratio = max_height / height
+    
+    # Only resize if we have at least one limit and the image exceeds it
+    if (max_width and width > max_width) or (max_height and height > max_height):
+        # Use the smaller ratio to ensure both dimensions fit within limits
+        ratio = min(width_ratio, height_ratio)
+        return int(width * ratio), int(height * ratio)
+    return None
+
+def get_output_path(img_path, custom_output_dir=None, preserve_structure=True, base_directory=None):
+    """Return the path of the .webp file produced for img_path."""
+    filename = os.path.basename(img_path)
+    directory = os.path.dirname(img_path)
+    
+    # If custom output directory is specified, use it for WebP output
+    if custom_output_dir:
+        # Default output directory is the custom output directory
+        output_dir = custom_output_dir
+        
+        # If preserving structure and we're not in the base directory
+        if preserve_structure and base_directory is not None and directory != base_directory:
+            # Get the path relative to the base directory
+            rel_path = os.path.relpath(directory, base_directory)
+            output_dir = os.path.join(custom_output_dir, rel_path)
+    else:
+        output_dir = directory
+    
+    return os.path.join(output_dir, os.path.splitext(filename)[0] + ".webp")
+
+@contextmanager
+def atomic_open(path, mode="wb", encoding=None):
+    """Open a temp file next to path that replaces path only if the block succeeds.
+    
+    The temporary file lives in the destination directory, so the final rename
+    is atomic on the same filesystem and readers never see a partial file.
+    """
+    directory = os.path.dirname(path) or "."
+    # Unlike mkstemp (owner-only), mode 0o666 lets the kernel apply the umask,
+    # so the result gets normal permissions
+    flags = os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, "O_BINARY", 0)
+    while True:
+        temp_path = os.path.join(directory, f".{os.path.basename(path)}.{os.urandom(6).hex()}.tmp")
+        try:
+            fd = os.open(temp_path, flags, 0o666)
+            break
+        except FileExistsError:
+            continue
+    try:
+        with os.fdopen(fd, mode, encoding=encoding) as f:
+            yield f
+        os.replace(temp_path, path)
+    except BaseException:
+        try:
+            os.remove(temp_path)
+        except OSError:
+            pass
+        raise
+
+def link_or_copy(src, dst):
+    """Fill dst with the contents of src as cheaply as the filesystem allows.
+    
+    Tries a hardlink, then a copy-on-write reflink (Linux FICLONE), then a plain
+    copy. dst is replaced atomically. Returns "hardlink", "reflink" or "copy".
+    """
+    directory = os.path.dirname(dst) or "."
+    temp_path = os.path.join(directory, f".{os.path.basename(dst)}.{os.getpid()}.link.tmp")
+    try:
+        os.link(src, temp_path)
+        os.replace(temp_path, dst)
+        return "hardlink"
+    except OSError:
+        try:
+            os.remove(temp_path)
+        except OSError:
+            pass
+    
+    if fcntl is not None and sys.platform.startswith("linux"):
+        try:
+            with open(src, "rb") as src_file, atomic_open(dst) as dst_file:
+                fcntl.ioctl(dst_file.fileno(), FICLONE, src_file.fileno())
+            return "reflink"
+        except OSError:
+            pass
+    
+    with open(src, "rb") as src_file, atomic_open(dst) as dst_file:
+        shutil.copyfileobj(src_file, dst_file)
+    return "copy"
+
+def sync_file(path):
+    """Force a file's data, and its directory entry where supported, to disk."""
+    with open(path, "rb+") as f:
+        os.fsync(f.fileno())
+    if os.name != "nt":
+        # The rename that created the file is only durable once the directory is synced
+        fd = os.open(os.path.dirname(path) or ".", os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+def file_digest(path, chunk_size=1024 * 1024):
+    """Return the SHA-256 hex digest of a file's contents."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def conversion_settings(max_width, max_height, preserve_exif, reducing_gap, encoder=None, variants=None,
+                        variant_sidecar=False):
+    """Return the settings that affect the output, as recorded in the manifest."""
+    settings = {
+        "max_width": max_width,
+        "max_height": max_height,
+        "preserve_exif": bool(preserve_exif),
+        "reducing_gap": reducing_gap,
+        "encoder": resolve_encoder(encoder).to_dict(),
+    }
+    if variants:
+        settings.update(variants=sorted(set(variants)), variant_sidecar=bool(variant_sidecar))
+    return settings
+
+def load_manifest(manifest_path):
+    """Load an incremental-mode manifest, returning an empty one if missing or unreadable."""
+    try:
+        with open(manifest_path, "r", encoding="utf-8") as f:
+            manifest = json.load(f)
+        if manifest.get("version") == MANIFEST_VERSION and isinstance(manifest.get("entries"), dict):
+            return manifest
+        print(f"Ignoring manifest with unknown format: {manifest_path}")
+    except FileNotFoundError:
+        pass
+    except (OSError, ValueError) as e:
+        print(f"Ignoring unreadable manifest {manifest_path}: {e}")
+    return {"version": MANIFEST_VERSION, "entries": {}}
+
+def save_manifest(manifest_path, manifest):
+    """Write the manifest atomically so an interrupted run never corrupts it."""
+    with atomic_open(manifest_path, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+
+def shard_of(rel_path, count):
+    """Return the shard (0 to count - 1) that owns a relative source path.
+    
+    Hashes the /-separated path, so every node given the same count agrees on
+    the partition, on any platform, without coordinating with the others.
+    """
+    digest = hashlib.sha256(rel_path.replace(os.sep, "/").encode("utf-8")).digest()
+    return int.from_bytes(digest[:8], "big") % count
+
+def parse_shard(spec):
+    """Parse "INDEX/COUNT" (0-based index) into an (index, count) tuple."""
+    try:
+        index, count = (int(part) for part in spec.split("/"))
+    except ValueError:
+        raise ValueError(f"Shard must look like INDEX/COUNT, got {spec!r}")
+    if not 0 <= index < count:
+        raise ValueError(f"Shard index must be between 0 and {count - 1}, got {index}")
+    return index, count
+
+def shard_filename(filename, shard):
+    """Name a per-shard state file: .opti_webp_manifest.shard-0-of-4.json."""
+    stem, ext = os.path.splitext(filename)
+    return f"{stem}.shard-{shard[0]}-of-{shard[1]}{ext}"
+
+def merge_summaries(summaries):
+    """Add up run summaries key by key (nested dicts like size_guard too)."""
+    merged = {}
+    for summary in summaries:
+        for key, value in summary.items():
+            if isinstance(value, dict):
+                merged[key] = merge_summaries([merged.get(key, {}), value])
+            elif isinstance(value, (int, float)) and not isinstance(value, bool):
+                merged[key] = merged.get(key, 0) + value
+    return merged
+
+def merge_shards(directory, count=None):
+    """Combine the per-shard reports and manifests in directory into one run summary.
+    
+    Sums the shard reports written by resize_and_convert(shard=...) into
+    REPORT_FILENAME and folds any shard manifests into the main manifest, each
+    replacing the entries of its own partition. count is read from the reports
+    if not given. Returns the merged summary; "missing_shards" lists shards
+    with no report yet. Raises ValueError if the shards used different settings.
+    """
+    report_pattern = re.compile(re.escape(os.path.splitext(REPORT_FILENAME)[0]) +
+                                r"\.shard-(\d+)-of-(\d+)" + re.escape(os.path.splitext(REPORT_FILENAME)[1]) + "$")
+    reports = {}
+    for name in sorted(os.listdir(directory)):
+        match = report_pattern.match(name)
+        if match and (count is None or int(match.group(2)) == count):
+            with open(os.path.join(directory, name), "r", encoding="utf-8") as f:
+                reports[(int(match.group(1)), int(match.group(2)))] = json.load(f)
+    counts = {shard_count for _, shard_count in reports}
+    if not reports:
+        raise ValueError(f"No shard reports found in {directory}")
+    if len(counts) > 1:
+        raise ValueError(f"Found reports for several shard counts ({', '.join(map(str, sorted(counts)))}); pass count")
+    count = counts.pop()
+    settings = [report["settings"] for report in reports.values()]
+    if any(other != settings[0] for other in settings[1:]):
+        raise ValueError("Shards were converted with different settings")
+    
+    summary = merge_summaries(report["summary"] for report in reports.values())
+    summary["shards"] = count
+    missing = [index for index in range(count) if (index, count) not in reports]
+    if missing:
+        summary["missing_shards"] = missing
+    
+    manifest_path = os.path.join(directory, MANIFEST_FILENAME)
+    manifest = None
+    for index in range(count):
+        shard_path = os.path.join(directory, shard_filename(MANIFEST_FILENAME, (index, count)))
+        if not os.path.exists(shard_path):
+            continue
+        if manifest is None:
+            manifest = load_manifest(manifest_path)
+        # The shard manifest is complete for its partition, dropped entries included
+        manifest["entries"] = {rel_path: entry for rel_path, entry in manifest["entries"].items()
+                               if shard_of(rel_path, count) != index}
+        manifest["entries"].update(load_manifest(shard_path)["entries"])
+    if manifest is not None:
+        save_manifest(manifest_path, manifest)
+    
+    report = {
+        "settings": settings[0],
+        "summary": summary,
+        # Shards run side by side, so the slowest one bounds the run
+        "seconds": max(report.get("seconds", 0.0) for report in reports.values()),
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+    }
+    with atomic_open(os.path.join(directory, REPORT_FILENAME), "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+    return summary
+
+def is_up_to_date(entry, item, settings, output_path):
+    """Check a manifest entry against a scanned source file.
+    
+    Returns (up_to_date, digest). The content hash is only computed when size
+    matches but mtime does not, so unchanged trees are checked with stat() alone.
+    """
+    if not entry or entry.get("settings") != settings:
+        return False, None
+    # Sources the size guard skipped have no output by design
+    if not entry.get("skipped") and not os.path.exists(output_path):
+        return False, None
+    if entry.get("size") != item.size:
+        return False, None
+    if entry.get("mtime_ns") == item.mtime_ns:
+        return True, entry.get("sha256")
+    digest = file_digest(item.path)
+    return digest == entry.get("sha256"), digest
+
+class EncoderOptions:
+    """WebP encoder settings, with optional overrides per source format.
+    
+    overrides maps a source format (as reported by Pillow, e.g. "PNG" or
+    "JPEG") to a dict of fields that replace the defaults for that format,
+    e.g. {"PNG": {"lossless": True}}.
+    
+    target_size (bytes) or target_bpp (bits per pixel) turn on byte-budget
+    mode: quality becomes a ceiling and is binary-searched downwards with
+    in-memory trial encodes (at most max_trials) for the highest value whose
+    output fits the budget.
+    
+    target_ssim turns on auto quality: the lowest quality whose decoded output
+    reaches that SSIM against the resized source is used (requires NumPy).
+    Combined with a budget, the budget can only lower the quality further.
+    Neither applies to animations.
+    
+    size_guard: when an encode is not smaller than the source file, fallbacks
+    (a sequence of field changes, e.g. {"lossless": True}) are tried in turn.
+    If none wins, "smallest" keeps the smallest encode and "skip" writes
+    nothing and leaves the source alone. None turns the guard off.
+    
+    frame_merge_threshold: consecutive animation frames in which no pixel
+    differs from the frame being held by more than this (0-255 per channel)
+    are merged into it, summing their durations. 0 merges exact repeats only;
+    None keeps every frame.
+    """
+    
+    FIELDS = ("quality", "method", "lossless", "near_lossless", "alpha_quality", "exact",
+              "target_size", "target_bpp", "target_ssim", "max_trials", "frame_merge_threshold",
+              "size_guard", "fallbacks")
+    
+    SIZE_GUARDS = (None, "smallest", "skip")
+    
+    # Size guard fallbacks, least lossy first
+    DEFAULT_FALLBACKS = ({"method": 6}, {"lossless": True}, {"quality": 60, "method": 6})
+    
+    # Named speed/size trade-offs; "balanced" matches Pillow's defaults
+    PROFILES = {
+        "fast": {"quality": 75, "method": 0},
+        "balanced": {"quality": 80, "method": 4},
+        "smallest": {"quality": 75, "method": 6},
+    }
+    
+    # Alternative spellings of source formats accepted in overrides
+    FORMAT_ALIASES = {"JPG": "JPEG", "TIF": "TIFF", "HEIC": "HEIF"}
+    
+    def __init__(self, quality=80, method=4, lossless=False, near_lossless=100, alpha_quality=100, exact=False,
+                 target_size=None, target_bpp=None, target_ssim=None, max_trials=8, frame_merge_threshold=0,
+                 size_guard=None, fallbacks=DEFAULT_FALLBACKS, overrides=None):
+        self.quality = quality
+        self.method = method
+        self.lossless = lossless
+        self.near_lossless = near_lossless
+        self.alpha_quality = alpha_quality
+        self.exact = exact
+        self.target_size = target_size
+        self.target_bpp = target_bpp
+        self.target_ssim = target_ssim
+        self.max_trials = max_trials
+        self.frame_merge_threshold = frame_merge_threshold
+        if size_guard not in self.SIZE_GUARDS:
+            raise ValueError(f"Unknown size guard '{size_guard}'. Choose from: smallest, skip")
+        self.size_guard = size_guard
+        self.fallbacks = [dict(changes) for changes in fallbacks]
+        for changes in self.fallbacks:
+            unknown = set(changes) - set(self.FIELDS)
+            if unknown:
+                raise ValueError(f"Unknown encoder option(s) in fallback: {', '.join(sorted(unknown))}")
+        self.overrides = {}
+        for source_format, changes in (overrides or {}).items():
+            unknown = set(changes) - set(self.FIELDS)
+            if unknown:
+                raise ValueError(f"Unknown encoder option(s) for {source_format}: {', '.join(sorted(unknown))}")
+            self.overrides[self.normalize_format(source_format)] = dict(changes)
+    
+    @classmethod
+    def from_profile(cls, name, **changes):
+        """Create options from a named profile, optionally adjusting some fields."""
+        if name not in cls.PROFILES:
+            raise ValueError(f"Unknown encoder profile '{name}'. Choose from: {', '.join(cls.PROFILES)}")
+        return cls(**dict(cls.PROFILES[name], **changes))
+    
+    @classmethod
+    def normalize_format(cls, source_format):
+        source_format = (source_format or "").upper()
+        return cls.FORMAT_ALIASES.get(source_format, source_format)
+    
+    def for_format(self, source_format):
+        """Return the options to use for a source of the given format."""
+        changes = self.overrides.get(self.normalize_format(source_format))
+        if not changes:
+            return self
+        return self.replace(overrides=None, **changes)
+    
+    def replace(self, **changes):
+        """Return a copy with some fields changed."""
+        values = self.to_dict()
+        values.update(changes)
+        return EncoderOptions(**values)
+    
+    def save_kwargs(self):
+        """Keyword arguments for Image.save(..., "WEBP")."""
+        return {
+            "quality": self.quality,
+            "method": self.method,
+            "lossless": self.lossless,
+            "alpha_quality": self.alpha_quality,
+            "exact": self.exact,
+        }
+    
+    def byte_budget(self, width, height):
+        """Return the byte budget for an output of the given size, or None."""
+        budgets = []
+        if self.target_size:
+            budgets.append(int(self.target_size))
+        if self.target_bpp:
+            budgets.append(int(self.target_bpp * width * height / 8))
+        return min(budgets) if budgets else None
+    
+    def to_dict(self):
+        values = {field: getattr(self, field) for field in self.FIELDS}
+        values["fallbacks"] = [dict(changes) for changes in self.fallbacks]
+        values["overrides"] = {fmt: dict(changes) for fmt, changes in sorted(self.overrides.items())}
+        return values
+    
+    def __repr__(self):
+        return f"EncoderOptions({', '.join(f'{k}={v!r}' for k, v in self.to_dict().items())})"
+
+def resolve_encoder(encoder):
+    """Accept None (balanced defaults), a profile name or an EncoderOptions instance."""
+    if encoder is None:
+        return EncoderOptions()
+    if isinstance(encoder, str):
+        return EncoderOptions.from_profile(encoder)
+    return encoder
+
+def apply_near_lossless(img, level):
+    """Approximate libwebp's near-lossless preprocessing, which Pillow does not expose.
+    
+    Like libwebp, level 100 is off and each step of 20 below it rounds away one
+    more low bit per color channel (up to 5 bits at level 0). Alpha is untouched.
+    """
+    bits = min(5, max(0, 5 - int(level) // 20))
+    if bits == 0 or img.mode not in ("L", "LA", "RGB", "RGBA"):
+        return img
+    step = 1 << bits
+    table = [min(255, ((value + step // 2) >> bits) << bits) for value in range(256)]
+    identity = list(range(256))
+    color_bands = 1 if img.mode in ("L", "LA") else 3
+    lut = table * color_bands + identity * (len(img.getbands()) - color_bands)
+    return img.point(lut)
+
+class Event:
+    """One structured record from the conversion pipeline.
+    
+    kind is one of EVENT_KINDS. seconds, pixels, input_bytes and output_bytes
+    are filled in where they apply to the stage; any extra keyword arguments
+    are kept in details.
+    """
+    
+    __slots__ = ("kind", "path", "timestamp", "seconds", "pixels", "input_bytes", "output_bytes", "details")
+    
+    def __init__(self, kind, path=None, seconds=None, pixels=None, input_bytes=None, output_bytes=None, **details):
+        self.kind = kind
+        self.path = path
+        self.timestamp = time.time()
+        self.seconds = seconds
+        self.pixels = pixels
+        self.input_bytes = input_bytes
+        self.output_bytes = output_bytes
+        self.details = details
+    
+    def __getstate__(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+    
+    def __setstate__(self, state):
+        for name, value in state.items():
+            setattr(self, name, value)
+    
+    def to_dict(self):
+        data = {"kind": self.kind, "timestamp": self.timestamp}
+        for name in ("path", "seconds", "pixels", "input_bytes", "output_bytes"):
+            value = getattr(self, name)
+            if value is not None:
+                data[name] = value
+        data.update(self.details)
+        return data
+    
+    def __repr__(self):
+        return f"Event({self.to_dict()!r})"
+
+class CallbackSink:
+    """Passes every event to a callable."""
+    
+    def __init__(self, callback):
+        self.callback = callback
+    
+    def emit(self, event):
+        self.callback(event)
+
+class JsonLinesSink:
+    """Appends each event as one JSON object per line to a file."""
+    
+    def __init__(self, path, append=True):
+        self.path = path
+        self._lock = threading.Lock()
+        self._file = open(path, "a" if append else "w", encoding="utf-8")
+    
+    def emit(self, event):
+        line = json.dumps(event.to_dict(), default=str)
+        with self._lock:
+            self._file.write(line + "\n")
+            self._file.flush()
+    
+    def close(self):
+        with self._lock:
+            self._file.close()
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc_info):
+        self.close()
+
+class JobJournal:
+    """Append-only record of finished items, for resuming an interrupted run.
+    
+    Writes one JSON object per line: a "run" header with the settings, then
+    a line per item that is done, failed, skipped or whose original was
+    deleted (done and skipped lines carry the source's size and mtime_ns),
+    and a "complete" line once the run has finished. durability is "none"
+    (left in Python's buffer), "flush" (handed to the OS after each line;
+    survives the program dying) or "fsync" (on disk after each line;
+    survives a power loss).
+    """
+    
+    DURABILITY_LEVELS = ("none", "flush", "fsync")
+    
+    def __init__(self, path, durability="flush", append=False):
+        if durability not in self.DURABILITY_LEVELS:
+            raise ValueError(f"Unknown durability '{durability}'. Choose from: {', '.join(self.DURABILITY_LEVELS)}")
+        self.path = path
+        self.durability = durability
+        self._lock = threading.Lock()
+        self._file = open(path, "a" if append else "w", encoding="utf-8")
+    
+    def write(self, record):
+        line = json.dumps(record, default=str)
+        with self._lock:
+            self._file.write(line + "\n")
+            if self.durability != "none":
+                self._file.flush()
+            if self.durability == "fsync":
+                os.fsync(self._file.fileno())
+    
+    def record(self, rel_path, status, **fields):
+        self.write(dict(path=rel_path, status=status, time=time.time(), **fields))
+    
+    def close(self):
+        with self._lock:
+            self._file.close()
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc_info):
+        self.close()
+
+def read_journal(path):
+    """Read a job journal and return (settings, last record per path, paths whose original was deleted, complete).
+    
+    complete is True if the run that wrote it finished. A torn last line from
+    a crash is ignored. Returns (None, {}, set(), False) if the journal does
+    not exist.
+    """
+    settings = None
+    records = {}
+    deleted = set()
+    complete = False
     try:
-        filename = os.path.basename(img_path)
-        directory = os.path.dirname(img_path)
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                complete = record.get("status") == "complete"
+                if record.get("status") == "run":
+                    settings = record.get("settings")
+                elif record.get("status") == "deleted":
+                    deleted.add(record["path"])
+                elif "path" in record:
+                    records[record["path"]] = record
+    except FileNotFoundError:
+        pass
+    return settings, records, deleted, complete
+
+class MetricsAggregator:
+    """Keeps running totals per event kind and remembers the slowest images."""
+    
+    def __init__(self, slowest=10):
+        self.slowest_limit = slowest
+        self._lock = threading.Lock()
+        self.counts = {}
+        self.seconds = {}
+        self.pixels = {}
+        self.input_bytes = 0
+        self.output_bytes = 0
+        self.memory = {}  # largest memory_bytes per stage
+        self.estimate_ratio = None  # worst peak / estimated memory of any image
+        self.slowest = []  # min-heap of (seconds, path)
+    
+    def emit(self, event):
+        with self._lock:
+            kind = event.kind
+            self.counts[kind] = self.counts.get(kind, 0) + 1
+            if event.seconds is not None:
+                self.seconds[kind] = self.seconds.get(kind, 0.0) + event.seconds
+            if event.pixels is not None:
+                self.pixels[kind] = self.pixels.get(kind, 0) + event.pixels
+            memory = event.details.get("memory_bytes", event.details.get("peak_memory_bytes"))
+            if memory is not None:
+                self.memory[kind] = max(self.memory.get(kind, 0), memory)
+            if event.details.get("estimated_memory_bytes") and event.details.get("peak_memory_bytes") is not None:
+                ratio = event.details["peak_memory_bytes"] / event.details["estimated_memory_bytes"]
+                self.estimate_ratio = max(self.estimate_ratio or 0.0, ratio)
+            if kind == "done":
+                self.input_bytes += event.input_bytes or 0
+                self.output_bytes += event.output_bytes or 0
+                entry = (event.seconds or 0.0, event.path)
+                if len(self.slowest) < self.slowest_limit:
+                    heapq.heappush(self.slowest, entry)
+                else:
+                    heapq.heappushpop(self.slowest, entry)
+    
+    def summary(self):
+        with self._lock:
+            return {
+                "counts": dict(self.counts),
+                "seconds": {kind: round(value, 6) for kind, value in self.seconds.items()},
+                "pixels": dict(self.pixels),
+                "input_bytes": self.input_bytes,
+                "output_bytes": self.output_bytes,
+                "peak_memory_bytes": dict(self.memory),
+                "memory_estimate_ratio": round(self.estimate_ratio, 3) if self.estimate_ratio is not None else None,
+                "slowest": [{"path": path, "seconds": round(seconds, 6)}
+                            for seconds, path in sorted(self.slowest, reverse=True)],
+            }
+
+class ConsoleSink:
+    """Prints the human-readable log line for each event (the default sink).
+    
+    stream defaults to stdout; the command line's pipe modes use stderr.
+    """
+    
+    def __init__(self, stream=None):
+        self.stream = stream
+    
+    def emit(self, event):
+        message = format_event(event)
+        if message:
+            print(message, file=self.stream or sys.stdout)
+
+class ResultLinesSink:
+    """Writes one JSON result line per finished image (done, error or size-guard skip)."""
+    
+    def __init__(self, stream):
+        self.stream = stream
+        self._lock = threading.Lock()
+        self.failed = 0
+    
+    def emit(self, event):
+        if event.kind == "done":
+            result = {"path": event.path, "ok": True, "output": event.details["output"],
+                      "input_bytes": event.input_bytes, "output_bytes": event.output_bytes,
+                      "seconds": round(event.seconds, 6)}
+            if "outputs" in event.details:
+                result["outputs"] = event.details["outputs"]
+        elif event.kind == "error" and event.path:
+            result = {"path": event.path, "ok": False, "error": event.details.get("error")}
+        elif event.kind == "skip" and event.details.get("reason") == "larger_than_source":
+            result = {"path": event.path, "ok": True, "skipped": "larger_than_source"}
+        else:
+            return
+        with self._lock:
+            if not result["ok"]:
+                self.failed += 1
+            self.stream.write(json.dumps(result) + "\n")
+            self.stream.flush()
+
+class MultiSink:
+    """Forwards every event to several sinks."""
+    
+    def __init__(self, sinks):
+        self.sinks = list(sinks)
+    
+    def emit(self, event):
+        for sink in self.sinks:
+            sink.emit(event)
+
+def format_event(event):
+    """Return the console log line for an event, or None if it is not logged."""
+    name = os.path.basename(event.path) if event.path else ""
+    details = event.details
+    if event.kind == "decode":
+        return f"Processing image: {name}"
+    if event.kind == "resize":
+        return f"Resized image from {details['from_width']}x{details['from_height']} to {details['width']}x{details['height']}"
+    if event.kind == "plan":
+        if details["action"] == "skip":
+            return f"Plan: {name}: skip ({details['reason']})"
+        outputs = ", ".join(f"{width}x{height}" for width, height in details["outputs"])
+        return (f"Plan: {name}: {details['action']} {details['width']}x{details['height']} -> {outputs} "
+                f"(~{event.seconds:.2f}s)")
+    if event.kind == "skip" and details.get("reason") == "larger_than_source":
+        return f"Skipping {name}: no WebP encode was smaller than the source"
+    if event.kind == "encode" and details.get("guard") in ("fallback", "smallest"):
+        if details["guard"] == "fallback":
+            changes = ", ".join(f"{key}={value}" for key, value in details["guard_fallback"].items())
+            return (f"WebP was larger than the source ({details['guard_first_bytes']} >= "
+                    f"{details['guard_source_bytes']} bytes); re-encoded with {changes} to {event.output_bytes} bytes")
+        return (f"WebP is larger than the source ({event.output_bytes} >= {details['guard_source_bytes']} bytes) "
+                f"even with fallbacks; kept the smallest encode")
+    if event.kind == "skip" and details.get("reason") == "small":
+        return f"Skipping {name}: already within limits and under {details['threshold']} bytes"
+    if event.kind == "encode" and "source_frames" in details:
+        return f"Encoded animation with {details['frames']} of {details['source_frames']} frames (similar frames merged)"
+    if event.kind == "encode" and "trials" in details:
+        notes = []
+        if "target_ssim" in details:
+            status = "" if details["ssim_met"] else ", target not reached"
+            notes.append(f"SSIM {details['ssim']} for target {details['target_ssim']}{status}")
+        if "budget" in details:
+            status = "fits" if details["fits"] else "over budget, kept smallest"
+            notes.append(f"byte budget {details['budget']} {status}")
+        return (f"Chose quality {details['quality']} ({event.output_bytes} bytes; {'; '.join(notes)}) "
+                f"after {details['trials']} trial encodes")
+    if event.kind == "write":
+        output_name = os.path.basename(details["output"])
+        if "reused_from" in details:
+            return (f"Reused WebP of {os.path.basename(details['reused_from'])} for identical {name} "
+                    f"({details['method']})")
+        return f"Converted image to WebP: {output_name}"
+    if event.kind == "delete" and details.get("mirrored"):
+        return f"Removed {os.path.basename(details['output'])} (source {name} was deleted)"
+    if event.kind == "delete":
+        return f"Deleted original image: {name}"
+    if event.kind == "error" and details.get("stage") == "scan":
+        return f"Could not read {event.path}: {details['error']}"
+    if event.kind == "error" and details.get("stage") == "watch":
+        if details.get("fallback"):
+            return f"inotify unavailable ({details['error']}); falling back to {details['fallback']}"
+        return f"Could not watch directory {event.path}: {details['error']}"
+    if event.kind == "error":
+        return f"An error occurred while processing image {name}: {details['error']}"
+    if event.kind == "run":
+        return format_run(event)
+    if event.kind == "summary":
+        return format_summary(event)
+    return None
+
+def format_run(event):
+    """Console lines announcing a resize_and_convert run (or watch_directory)."""
+    details = event.details
+    if details.get("watch"):
+        return f"Watching {event.path} for new or changed images ({details['watcher']}); press Ctrl+C to stop"
+    lines = [f"Processing images in directory: {event.path}"]
+    if details["shard"]:
+        lines.append(f"Processing shard {details['shard'][0]} of {details['shard'][1]} (0-based)")
+    lines.append(f"Using max width: {details['max_width']}, max height: {details['max_height']}")
+    if details["variants"]:
+        lines.append(f"Generating width variants: {', '.join(str(width) for width in details['variants'])}")
+    lines.append(f"Processing subdirectories: {'Yes' if details['process_subdirs'] else 'No'}")
+    lines.append(f"Encoder settings: {details['encoder']}")
+    if details["output_dir"]:
+        lines.append(f"Saving all WebP images to: {details['output_dir']}")
+        lines.append(f"Preserving folder structure: {'Yes' if details['preserve_structure'] else 'No'}")
+    if details["journal"]:
+        lines.append(details["journal"])
+    if details["workers"] > 1 and not details["dry_run"]:
+        lines.append(f"Using {details['workers']} worker processes")
+        if details["memory_budget"]:
+            lines.append(f"Memory budget for concurrent images: {details['memory_budget'] / 1024 ** 2:.0f} MB")
+    return "\n".join(lines)
+
+def format_summary(event):
+    """Console lines closing a resize_and_convert run (or dry run, or watch_directory)."""
+    summary = event.details["summary"]
+    lines = []
+    if summary.get("scan_errors"):
+        lines.append(f"Could not read {summary['scan_errors']} files or folders while scanning.")
+    if event.details.get("watch"):
+        lines.append(f"Stopped watching. Processed {summary['processed']} images ({summary['failed']} failed), "
+                     f"removed {summary['removed']} mirrored outputs.")
+        return "\n".join(lines)
+    if event.details["dry_run"]:
+        actions = ", ".join(f"{count} {action}" for action, count in sorted(summary["planned"].items()))
+        lines += [f"Optimizable Images found: {summary['found']}",
+                  "Dry run plan: " + actions + (f", {summary['skipped']} up to date" if summary["skipped"] else ""),
+                  f"Estimated work: {summary['estimated_seconds']:.1f}s CPU, "
+                  f"about {summary['estimated_wall_seconds']:.1f}s with {summary['workers']} worker(s)"]
+        return "\n".join(lines)
+    if not summary["found"]:
+        return "\n".join(lines + ["No optimizable images found."])
+    attempted = (summary["found"] - summary["skipped"] - summary.get("skipped_small", 0) -
+                 summary.get("resumed", 0))
+    lines += [f"Optimizable Images found: {summary['found']}",
+              f"Successfully processed {summary['processed']} out of {attempted} images."]
+    if summary.get("resumed"):
+        lines.append(f"Skipped {summary['resumed']} images finished by the interrupted run.")
+    if summary["skipped"]:
+        lines.append(f"Skipped {summary['skipped']} up-to-date images.")
+    if summary.get("skipped_small"):
+        lines.append(f"Skipped {summary['skipped_small']} images already within limits and under "
+                     f"{event.details['threshold']} bytes.")
+    guard_counts = summary.get("size_guard")
+    if guard_counts:
+        lines.append(f"Size guard: {guard_counts.get('fallback', 0)} re-encoded smaller with a fallback, "
+                     f"{guard_counts.get('smallest', 0)} kept larger than the source, "
+                     f"{guard_counts.get('skip', 0)} skipped.")
+    if summary.get("duplicates"):
+        lines.append(f"Deduplicated {summary['duplicates']} identical images: saved "
+                     f"{summary['dedup_saved_seconds']:.1f}s of encoding and "
+                     f"{summary['dedup_saved_bytes'] / 1024:.1f} KB of output space.")
+    return "\n".join(lines)
+
+def resolve_sink(events):
+    """Accept None (console output), a sink with emit(), a callable or a list of those."""
+    if events is None:
+        return ConsoleSink()
+    if isinstance(events, (list, tuple)):
+        return MultiSink(resolve_sink(sink) for sink in events)
+    if hasattr(events, "emit"):
+        return events
+    return CallbackSink(events)
+
+def encode_webp(img, options, exif=None, quality=None):
+    """Encode img to WebP in memory and return the bytes."""
+    save_kwargs = options.save_kwargs()
+    if quality is not None:
+        save_kwargs["quality"] = quality
+    if exif is not None:
+        save_kwargs["exif"] = exif
+    buffer = io.BytesIO()
+    img.save(buffer, "WEBP", **save_kwargs)
+    return buffer.getvalue()
+
+def luma_plane(img, max_side=SSIM_MAX_SIDE):
+    """Return img's luma as a float64 array, downsampled so its longer side is at most max_side."""
+    gray = img.convert("L")
+    scale = max_side / max(gray.size)
+    if scale < 1:
+        gray = gray.resize((max(1, round(gray.width * scale)), max(1, round(gray.height * scale))), Image.BOX)
+    return numpy.asarray(gray, dtype=numpy.float64)
+
+def ssim(a, b, window=8):
+    """Mean SSIM of two equally sized luma planes.
+    
+    Uses uniform window x window statistics computed for every window position
+    at once from summed-area tables, so the cost is a handful of array passes.
+    """
+    window = max(1, min(window, a.shape[0], a.shape[1]))
+    c1 = (0.01 * 255) ** 2
+    c2 = (0.03 * 255) ** 2
+    
+    def window_mean(x):
+        table = numpy.pad(x.cumsum(axis=0).cumsum(axis=1), ((1, 0), (1, 0)))
+        sums = table[window:, window:] - table[:-window, window:] - table[window:, :-window] + table[:-window, :-window]
+        return sums / (window * window)
+    
+    mean_a = window_mean(a)
+    mean_b = window_mean(b)
+    var_a = window_mean(a * a) - mean_a * mean_a
+    var_b = window_mean(b * b) - mean_b * mean_b
+    covariance = window_mean(a * b) - mean_a * mean_b
+    ssim_map = ((2 * mean_a * mean_b + c1) * (2 * covariance + c2)) / \
+               ((mean_a * mean_a + mean_b * mean_b + c1) * (var_a + var_b + c2))
+    return float(ssim_map.mean())
+
+def find_highest_quality(trial, fits, low, high, max_trials, tried):
+    """Binary-search the highest quality in [low, high] whose encode fits.
+    
+    trial(quality) returns the (cached) encode; tried() returns how many
+    encodes have been made so far, which is capped at max_trials. Returns the
+    quality found, or None if nothing tried fits.
+    """
+    # Try the ceiling first: most images already fit and need one encode
+    if fits(trial(high)):
+        return high
+    
+    best = None
+    high -= 1
+    while low <= high and tried() < max_trials:
+        middle = (low + high + 1) // 2
+        if fits(trial(middle)):
+            best = middle
+            low = middle + 1
+        else:
+            high = middle - 1
+    return best
+
+def find_lowest_quality(trial, accept, low, high, max_trials, tried):
+    """Binary-search the lowest quality in [low, high] whose encode is accepted.
+    
+    Same conventions as find_highest_quality(); returns None if nothing tried
+    is accepted.
+    """
+    best = None
+    while low <= high and tried() < max_trials:
+        middle = (low + high) // 2
+        if accept(trial(middle)):
+            best = middle
+            high = middle - 1
+        else:
+            low = middle + 1
+    return best
+
+def guard_output_size(data, source_bytes, options, encode, mode=None):
+    """Try options.fallbacks for an encode that is not smaller than its source.
+    
+    encode(options) re-encodes with other options. Fallbacks are tried in
+    order until one beats source_bytes. If none does, mode ("smallest" or
+    "skip", defaulting to options.size_guard) decides between keeping the
+    smallest encode and returning None. Returns (data, details for the event).
+    """
+    mode = mode or options.size_guard
+    details = {"guard": None, "guard_source_bytes": source_bytes, "guard_first_bytes": len(data)}
+    best = data
+    for changes in options.fallbacks:
+        candidate = encode(options.replace(**changes))
+        if len(candidate) < len(best):
+            best = candidate
+        if len(candidate) < source_bytes:
+            details.update(guard="fallback", guard_fallback=dict(changes))
+            return candidate, details
+    if mode == "skip":
+        details["guard"] = "skip"
+        return None, details
+    details["guard"] = "smallest"
+    return best, details
+
+def encode_with_targets(img, options, exif=None):
+    """Encode img, applying auto quality (target SSIM) and/or a byte budget.
+    
+    Auto quality picks the lowest quality whose decoded output reaches
+    options.target_ssim against img; a byte budget then lowers that further if
+    needed. Both searches share one cache of in-memory trial encodes, capped at
+    options.max_trials. Returns (data, report); report is None when neither
+    target is set.
+    """
+    budget = options.byte_budget(*img.size)
+    if options.lossless or (budget is None and not options.target_ssim):
+        return encode_webp(img, options, exif), None
+    
+    trials = {}
+    max_trials = max(1, int(options.max_trials))
+    
+    def trial(quality):
+        if quality not in trials:
+            trials[quality] = encode_webp(img, options, exif, quality)
+        return trials[quality]
+    
+    report = {}
+    quality = int(options.quality)
+    
+    if options.target_ssim:
+        if numpy is None:
+            raise RuntimeError("Auto quality (target_ssim) requires NumPy. To enable it, run: pip install numpy")
+        reference = luma_plane(img)
+        scores = {}
         
-        print(f"Processing image: {filename}")
+        def score(data):
+            if data not in scores:
+                with Image.open(io.BytesIO(data)) as decoded:
+                    scores[data] = ssim(reference, luma_plane(decoded.resize(img.size) if decoded.size != img.size else decoded))
+            return scores[data]
         
-        # Step 1: Loading
-        img = Image.open(img_path)
-        exif_data = None
-        if preserve_exif and hasattr(img, 'info') and 'exif' in img.info:
-            exif_data = img.info['exif']
+        found = find_lowest_quality(trial, lambda data: score(data) >= options.target_ssim,
+                                    0, 100, max_trials, lambda: len(trials))
+        # If no quality tried reaches the target, use the best one tried
+        quality = found if found is not None else max(trials)
+    
+    if budget is not None:
+        found = find_highest_quality(trial, lambda data: len(data) <= budget,
+                                     0, quality, max_trials, lambda: len(trials))
+        if found is None:
+            # Nothing fits: keep the smallest encode tried
+            found = min(trials, key=lambda q: len(trials[q]))
+        quality = found
+        report.update(budget=budget, fits=len(trials[quality]) <= budget)
+    
+    data = trial(quality)
+    if options.target_ssim:
+        achieved = score(data)
+        report.update(target_ssim=options.target_ssim, ssim=round(achieved, 5),
+                      ssim_met=achieved >= options.target_ssim)
+    report.update(quality=quality, size=len(data), trials=len(trials))
+    return data, report
+
+def target_sizes(width, height, max_width, max_height, variants=None):
+    """Return the output sizes for a source, largest first (None keeps the source size).
+    
+    Each variant width is capped at max_width, as it is at the source width.
+    """
+    if variants:
+        return [calculate_target_size(width, height, min(variant_width, max_width or variant_width), max_height)
+                for variant_width in sorted(set(variants), reverse=True)]
+    return [calculate_target_size(width, height, max_width, max_height)]
+
+def apply_draft(img, target_size, reducing_gap):
+    """Let the decoder shrink while loading where the format allows it (JPEG DCT
+    scaling), keeping at least reducing_gap times target_size. Header-only."""
+    if target_size and reducing_gap:
+        img.draft(None, (int(target_size[0] * reducing_gap), int(target_size[1] * reducing_gap)))
+
+def bitmap_bytes(mode, size):
+    """Bytes Pillow allocates for an image of this mode and size."""
+    # Pillow keeps 8-bit single-band images in one byte per pixel, 16-bit ones in
+    # two, and everything else (RGB included) in four
+    if mode in ("1", "L", "P"):
+        bytes_per_pixel = 1
+    elif mode.startswith("I;16"):
+        bytes_per_pixel = 2
+    else:
+        bytes_per_pixel = 4
+    return size[0] * size[1] * bytes_per_pixel
+
+def estimate_memory(mode, decoded_size, output_sizes, frames=1):
+    """Estimate the peak memory (bytes) process_image needs for one source.
+    
+    decoded_size is what the decoder produces (after draft()); output_sizes
+    are target_sizes() for the job. Counts the decoded bitmap, the largest
+    resized copy and the encoder's working set; for animations, the current
+    frame and its RGBA copy plus every resized frame (none merged).
+    """
+    largest = output_sizes[0] or decoded_size
+    output_pixels = largest[0] * largest[1]
+    encode = output_pixels * ENCODE_BYTES_PER_PIXEL
+    if frames > 1:
+        return bitmap_bytes(mode, decoded_size) + bitmap_bytes("RGBA", decoded_size) + frames * 4 * output_pixels + encode
+    resized = bitmap_bytes(mode, largest) if output_sizes[0] else 0
+    return bitmap_bytes(mode, decoded_size) + resized + encode
+
+def estimate_job_memory(job):
+    """Estimate a process_image job's peak memory from the source's header alone."""
+    with Image.open(job["img_path"]) as img:
+        sizes = target_sizes(img.width, img.height, job.get("max_width"), job.get("max_height"), job.get("variants"))
+        animated = is_animation(img)
+        if not animated:
+            apply_draft(img, sizes[0], job.get("reducing_gap", DEFAULT_REDUCING_GAP))
+        return estimate_memory(img.mode, img.size, sizes, getattr(img, "n_frames", 1) if animated else 1)
+
+# Highest RSS seen before memory_usage reset the kernel's high-water mark
+_peak_rss_before_reset = 0
+_peak_rss_lock = threading.Lock()
+
+def max_rss_bytes():
+    """Peak resident set size of this process so far, or None where unsupported."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    peak = peak if sys.platform == "darwin" else peak * 1024
+    return max(peak, _peak_rss_before_reset)
+
+def proc_status_bytes(field):
+    """Read a kB field such as VmRSS or VmHWM from /proc/self/status (Linux), or None."""
+    try:
+        with open("/proc/self/status", "r", encoding="ascii") as f:
+            for line in f:
+                if line.startswith(field + ":"):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError):
+        pass
+    return None
+
+def rss_bytes():
+    """Current resident set size of this process, or None where it can't be read."""
+    rss = proc_status_bytes("VmRSS")
+    if rss is None and psutil is not None:
+        rss = psutil.Process().memory_info().rss
+    return rss
+
+def reset_peak_rss():
+    """Reset the kernel's RSS high-water mark (Linux); returns False where that's unsupported."""
+    global _peak_rss_before_reset
+    peak = proc_status_bytes("VmHWM")
+    if peak is None:
+        return False
+    with _peak_rss_lock:
+        _peak_rss_before_reset = max(_peak_rss_before_reset, peak)
+        try:
+            with open("/proc/self/clear_refs", "w", encoding="ascii") as f:
+                f.write("5")
+        except OSError:
+            return False
+    return True
+
+@contextmanager
+def memory_usage(baseline):
+    """Measure how far resident memory rises above baseline (an earlier rss_bytes()) during a block.
+    
+    Yields a dict that receives memory_bytes. On Linux the kernel's peak RSS
+    is reset first, so short-lived buffers (e.g. the encoder's) are caught;
+    elsewhere the larger of the RSS before and after the block is used.
+    None where RSS can't be read. The figure is process-wide, so other
+    threads' allocations count too, and memory the allocator kept from
+    earlier work is reused without counting. Resetting the peak also hides
+    it from the rest of the process, which is why callers only measure when
+    asked to (measure_memory).
+    """
+    result = {"memory_bytes": None}
+    peak_tracked = reset_peak_rss()
+    before = rss_bytes()
+    try:
+        yield result
+    finally:
+        after = proc_status_bytes("VmHWM") if peak_tracked else rss_bytes()
+        if None not in (baseline, before, after):
+            result["memory_bytes"] = max(0, before - baseline, after - baseline)
+
+def estimate_seconds(source_format, decoded_size, output_sizes, options, frames=1):
+    """Rough CPU seconds process_image needs for one source (see the *_SECONDS_PER_MP tables)."""
+    decoded_mp = decoded_size[0] * decoded_size[1] / 1e6
+    seconds = DECODE_SECONDS_PER_MP.get(EncoderOptions.normalize_format(source_format), DEFAULT_DECODE_SECONDS_PER_MP) * decoded_mp
+    if options.lossless:
+        encode_per_mp = LOSSLESS_ENCODE_SECONDS_PER_MP
+    else:
+        encode_per_mp = ENCODE_SECONDS_PER_MP.get(options.method, ENCODE_SECONDS_PER_MP[4])
+    trials = 1
+    if not options.lossless and (options.target_size or options.target_bpp or options.target_ssim):
+        # A binary search over 0-100 takes about seven trial encodes
+        trials = min(7, max(1, int(options.max_trials)))
+    previous_mp = decoded_mp
+    encoded = set()
+    for size in output_sizes:
+        size = size or decoded_size
+        output_mp = size[0] * size[1] / 1e6
+        if output_mp != previous_mp:
+            seconds += RESIZE_SECONDS_PER_MP * previous_mp
+            previous_mp = output_mp
+        if size not in encoded:
+            # Variants that collapse to one size share an encode
+            encoded.add(size)
+            seconds += encode_per_mp * output_mp * trials
+    return seconds * frames
+
+def plan_image(img_path, max_width, max_height, reducing_gap=DEFAULT_REDUCING_GAP, encoder=None, variants=None,
+               skip_smaller_than=None):
+    """Plan the work for one source from its header alone (no pixels are decoded).
+    
+    Returns a dict with the header facts (format, width, height, mode, frames,
+    EXIF orientation), the action -- "resize", "encode" or "skip" (with a
+    reason) -- the output sizes, and estimated seconds and peak memory.
+    Sources within the limits and smaller than skip_smaller_than bytes are
+    skipped.
+    """
+    source_bytes = os.path.getsize(img_path)
+    with Image.open(img_path) as img:
+        try:
+            orientation = img.getexif().get(EXIF_ORIENTATION, 1)
+        except Exception:
+            orientation = 1
+        animated = is_animation(img)
+        frames = img.n_frames if animated else 1
+        sizes = target_sizes(img.width, img.height, max_width, max_height, variants)
+        entry = {"path": img_path, "format": img.format, "width": img.width, "height": img.height,
+                 "mode": img.mode, "frames": frames, "orientation": orientation, "bytes": source_bytes}
+        if not animated:
+            apply_draft(img, sizes[0], reducing_gap)
+        decoded_size = img.size
+        options = resolve_encoder(encoder).for_format(img.format)
+        mode = img.mode
+    
+    resize = any(sizes)
+    if not resize and skip_smaller_than and source_bytes < skip_smaller_than:
+        entry.update(action="skip", reason="small", outputs=[], estimated_seconds=0.0, estimated_memory_bytes=0)
+        return entry
+    entry.update(
+        action="resize" if resize else "encode",
+        outputs=[list(size or (entry["width"], entry["height"])) for size in sizes],
+        estimated_seconds=round(estimate_seconds(entry["format"], decoded_size, sizes, options, frames), 4),
+        estimated_memory_bytes=estimate_memory(mode, decoded_size, sizes, frames),
+    )
+    return entry
+
+def summarize_plan(planned, found, skipped, workers=1):
+    """Return the totals of a dry-run plan (a list of plan_image entries)."""
+    actions = {}
+    for entry in planned:
+        actions[entry["action"]] = actions.get(entry["action"], 0) + 1
+    estimated_seconds = sum(entry.get("estimated_seconds") or 0.0 for entry in planned)
+    estimated_wall = estimated_seconds / max(1, workers)
+    return {
+        "found": found,
+        "skipped": skipped,
+        "planned": actions,
+        "estimated_seconds": round(estimated_seconds, 3),
+        "estimated_wall_seconds": round(estimated_wall, 3),
+        "workers": workers,
+        "peak_memory_bytes": max((entry.get("estimated_memory_bytes") or 0 for entry in planned), default=0),
+    }
+
+def is_animation(img):
+    """True if img is a multi-frame image that should stay animated."""
+    return img.format in ANIMATED_FORMATS and getattr(img, "is_animated", False)
+
+def animation_loop(img):
+    """Return the WebP loop count (0 = forever) for an animated source."""
+    if img.format == "GIF":
+        # GIF stores extra repetitions and omits the extension to play once
+        loop = img.info.get("loop")
+        if loop is None:
+            return 1
+        return loop + 1 if loop else 0
+    return img.info.get("loop", 0)
+
+def frame_difference(a, b):
+    """Largest per-pixel, per-channel difference between two frames of the same size and mode (0-255).
+    
+    A maximum rather than a mean, so a small moving element counts as much
+    as a change across the whole frame.
+    """
+    extrema = ImageChops.difference(a, b).getextrema()
+    if isinstance(extrema[0], tuple):
+        return max(high for _, high in extrema)
+    return extrema[1]
+
+def iter_animation_frames(img, target_size=None, merge_threshold=None, reducing_gap=DEFAULT_REDUCING_GAP, stats=None):
+    """Yield (frame, duration in ms) for the distinct frames of an animated image.
+    
+    Frames are decoded one at a time (Pillow composites each onto the ones
+    before it), converted to RGBA and resized to target_size, so only the
+    current full-size frame is ever held. A frame within merge_threshold of
+    the held one (see frame_difference) extends its duration instead of being
+    yielded. If given, stats collects frame counts and resize time.
+    """
+    if stats is None:
+        stats = {}
+    stats.update(source_frames=0, frames=0, resize_seconds=0.0)
+    held, held_duration = None, 0
+    for index in range(getattr(img, "n_frames", 1)):
+        img.seek(index)
+        duration = img.info.get("duration", 0) or 0
+        frame = img.convert("RGBA")
+        stats["source_frames"] += 1
+        if target_size:
+            started = time.perf_counter()
+            frame = frame.resize(target_size, Image.LANCZOS, reducing_gap=reducing_gap)
+            stats["resize_seconds"] += time.perf_counter() - started
+        if held is not None and merge_threshold is not None and frame_difference(held, frame) <= merge_threshold:
+            held_duration += duration
+            continue
+        if held is not None:
+            stats["frames"] += 1
+            yield held, held_duration
+        held, held_duration = frame, duration
+    if held is not None:
+        stats["frames"] += 1
+        yield held, held_duration
+
+def encode_animated_webp(frames, options, loop=0, exif=None):
+    """Encode (frame, duration) pairs as an animated WebP and return the bytes.
+    
+    Only the (already resized) distinct frames are kept until Pillow encodes
+    them. Byte budgets and auto quality are not applied to animations.
+    """
+    images, durations = [], []
+    for frame, duration in frames:
+        if options.lossless and options.near_lossless < 100:
+            frame = apply_near_lossless(frame, options.near_lossless)
+        images.append(frame)
+        durations.append(duration)
+    save_kwargs = options.save_kwargs()
+    save_kwargs.update(save_all=True, append_images=images[1:], duration=durations, loop=loop)
+    if exif is not None:
+        save_kwargs["exif"] = exif
+    buffer = io.BytesIO()
+    images[0].save(buffer, "WEBP", **save_kwargs)
+    return buffer.getvalue()
+
+def variant_path(webp_path, width):
+    """Return the output path of the variant of webp_path for the given width."""
+    return f"{os.path.splitext(webp_path)[0]}-{width}.webp"
+
+def sidecar_path(webp_path):
+    """Return the path of the JSON sidecar describing webp_path's variants."""
+    return os.path.splitext(webp_path)[0] + ".json"
+
+def output_paths(webp_path, variants=None, variant_sidecar=False):
+    """Return every file a job writes for webp_path, main output first."""
+    if not variants:
+        return [webp_path]
+    paths = [variant_path(webp_path, width) for width in sorted(set(variants), reverse=True)]
+    if variant_sidecar:
+        paths.append(sidecar_path(webp_path))
+    return paths
+
+def encode_outputs(img, source_bytes, sizes, encoder=None, preserve_exif=False, reducing_gap=DEFAULT_REDUCING_GAP,
+                   guard_mode=None, sink=None, label=None, progress_callback=None, stats=None,
+                   measure_memory=False):
+    """Decode an opened image once and yield (index, (width, height), webp bytes) per size in sizes.
+    
+    This is the in-memory core of process_image; it touches no files. img is
+    fresh from Image.open (not yet loaded) and sizes come from target_sizes()
+    (largest first; None keeps the source size). source_bytes is the encoded
+    source size, for the size guard; guard_mode overrides the encoder's
+    size_guard, and data is None for outputs the guard skips. Events are
+    emitted to sink with label as their path. With measure_memory, stage
+    events carry the memory measured above the RSS at the start (see
+    memory_usage); otherwise their memory_bytes is None. stats, if given,
+    receives the measured peak and the estimate.
+    """
+    sink = sink if sink is not None else resolve_sink(None)
+    options = resolve_encoder(encoder).for_format(img.format)
+    exif = img.info.get("exif") if preserve_exif else None
+    width, height = img.size
+    animated = is_animation(img)
+    
+    # The largest output decides how far the decoder may shrink
+    if not animated:
+        apply_draft(img, sizes[0], reducing_gap)
+    estimated_memory = estimate_memory(img.mode, img.size, sizes, img.n_frames if animated else 1)
+    baseline = rss_bytes() if measure_memory else None
+    peak_memory = None
+    
+    def measured_stage():
+        return memory_usage(baseline) if measure_memory else nullcontext({"memory_bytes": None})
+    
+    def track(memory):
+        nonlocal peak_memory
+        if memory is not None:
+            peak_memory = max(peak_memory or 0, memory)
+        return memory
+    
+    if not animated:
+        started = time.perf_counter()
+        with measured_stage() as measured:
+            img.load()
+        memory = track(measured["memory_bytes"])
+        sink.emit(Event("decode", label, time.perf_counter() - started, width * height, source_bytes,
+                        format=img.format, mode=img.mode, width=width, height=height,
+                        decoded_width=img.width, decoded_height=img.height, memory_bytes=memory))
         if progress_callback:
             progress_callback(0.2)  # 20% progress for loading
-        
-        # Calculate aspect ratio
-        width, height = img.size
-        aspect_ratio = width / height
-        
-        # Initialize scaling ratios
-        width_ratio = float('inf')
-        height_ratio = float('inf')
-        
-        # Calculate ratios only for enabled dimensions
-        if max_width:
-            width_ratio = max_width / width
-        if max_height:
-            height_ratio = max_height / height
-        
-        # Only resize if we have at least one limit and the image exceeds it
-        if (max_width and width > max_width) or (max_height and height > max_height):
-            # Use the smaller ratio to ensure both dimensions fit within limits
-            ratio = min(width_ratio, height_ratio)
-            
-            new_width = int(width * ratio)
-            new_height = int(height * ratio)
+    
+    previous = None
+    for index, output_size in enumerate(sizes):
+        if animated:
+            # Decode, resize and merge frames as one stream; only distinct
+            # resized frames are kept for the encoder
+            started = time.perf_counter()
+            frame_stats = {}
+            with measured_stage() as measured:
+                frames = list(iter_animation_frames(img, output_size, options.frame_merge_threshold,
+                                                    reducing_gap, frame_stats))
+            elapsed = time.perf_counter() - started
+            source_frames = frame_stats["source_frames"]
+            memory = track(measured["memory_bytes"])
+            sink.emit(Event("decode", label, elapsed - frame_stats["resize_seconds"], width * height * source_frames,
+                            source_bytes, format=img.format, mode=img.mode, width=width, height=height,
+                            decoded_width=width, decoded_height=height, frames=source_frames,
+                            memory_bytes=memory))
+            if progress_callback and index == 0:
+                progress_callback(0.2)  # 20% progress for loading
+            if output_size:
+                sink.emit(Event("resize", label, frame_stats["resize_seconds"],
+                                output_size[0] * output_size[1] * source_frames,
+                                from_width=width, from_height=height, width=output_size[0], height=output_size[1]))
+        elif output_size and img.size != output_size:
+            new_width, new_height = output_size
+            from_width, from_height = (width, height) if previous is None else img.size
             
-            # Step 2: Resize the image
-            img = img.resize((new_width, new_height), Image.LANCZOS)
-            print(f"Resized image from {width}x{height} to {new_width}x{new_height}")
+            # Step 2: Resize the image (or the previous, larger variant); reduce()
+            # by an integer factor first and finish with a high-quality LANCZOS pass
+            started = time.perf_counter()
+            with measured_stage() as measured:
+                img = img.resize((new_width, new_height), Image.LANCZOS, reducing_gap=reducing_gap)
+            memory = track(measured["memory_bytes"])
+            sink.emit(Event("resize", label, time.perf_counter() - started, new_width * new_height,
+                            from_width=from_width, from_height=from_height, width=new_width, height=new_height,
+                            memory_bytes=memory))
         
-        if progress_callback:
+        if progress_callback and index == 0:
             progress_callback(0.4)  # 40% progress after potential resize
-
-        # Determine where to save the files
-        temp_dir = directory  # For temporary resized PNG
         
-        # If custom output directory is specified, use it for WebP output
-        if custom_output_dir:
-            # Default output directory is the custom output directory
-            output_dir = custom_output_dir
-            
-            # If preserving structure and we're not in the base directory
-            if preserve_structure and base_directory is not None and directory != base_directory:
-                # Get the path relative to the base directory
-                rel_path = os.path.relpath(directory, base_directory)
-                output_dir = os.path.join(custom_output_dir, rel_path)
-                os.makedirs(output_dir, exist_ok=True)
+        # Step 3: Encode to WebP in memory (variants that collapse to the
+        # same size, e.g. because the source is small, reuse the encode)
+        output_width, output_height = output_size or (width, height)
+        if previous is not None and previous[0] == (output_width, output_height):
+            data = previous[1]
         else:
-            output_dir = directory
+            started = time.perf_counter()
+            with measured_stage() as measured:
+                if animated:
+                    loop = animation_loop(img)
+                    
+                    def encode(encode_options):
+                        return encode_animated_webp(frames, encode_options, loop, exif)
+                    
+                    data = encode(options)
+                    pixels = output_width * output_height * len(frames)
+                    details = {"frames": len(frames), "source_frames": source_frames}
+                else:
+                    def encode(encode_options):
+                        encode_img = img
+                        if encode_options.lossless and encode_options.near_lossless < 100:
+                            encode_img = apply_near_lossless(img, encode_options.near_lossless)
+                        return encode_webp(encode_img, encode_options, exif)
+                    
+                    encode_img = img
+                    if options.lossless and options.near_lossless < 100:
+                        encode_img = apply_near_lossless(img, options.near_lossless)
+                    data, search_report = encode_with_targets(encode_img, options, exif)
+                    pixels = img.width * img.height
+                    details = dict(search_report or {})
+                if options.size_guard and len(data) >= source_bytes:
+                    data, decision = guard_output_size(data, source_bytes, options, encode, guard_mode)
+                    details.update(decision)
+            memory = track(measured["memory_bytes"])
+            sink.emit(Event("encode", label, time.perf_counter() - started, pixels,
+                            output_bytes=len(data) if data is not None else None, memory_bytes=memory, **details))
+            frames = None
+            previous = ((output_width, output_height), data)
+        
+        if stats is not None:
+            stats.update(peak_memory_bytes=peak_memory, estimated_memory_bytes=estimated_memory)
+        yield index, (output_width, output_height), data
+
+class BufferReader(io.RawIOBase):
+    """A seekable, read-only file over a bytes-like object that never copies it whole."""
+    
+    def __init__(self, buffer):
+        self._view = memoryview(buffer).cast("B")
+        self._position = 0
+    
+    def readable(self):
+        return True
+    
+    def seekable(self):
+        return True
+    
+    def read(self, size=-1):
+        end = len(self._view) if size is None or size < 0 else min(len(self._view), self._position + size)
+        data = self._view[self._position:end].tobytes()
+        self._position = max(self._position, end)
+        return data
+    
+    def readinto(self, buffer):
+        chunk = self._view[self._position:self._position + len(buffer)]
+        buffer[:len(chunk)] = chunk
+        self._position += len(chunk)
+        return len(chunk)
+    
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self._position
+        elif whence == io.SEEK_END:
+            offset += len(self._view)
+        if offset < 0:
+            raise ValueError("negative seek position")
+        self._position = offset
+        return offset
+    
+    def tell(self):
+        return self._position
+    
+    def __len__(self):
+        return len(self._view)
 
-        # Step 3: Save as PNG (temporary)
-        new_filename = os.path.splitext(filename)[0] + "_resized.png"
-        new_path = os.path.join(temp_dir, new_filename)
-        img.save(new_path, "PNG", optimize=True)
-        print(f"Saved resized image as: {new_filename}")
+class OffsetReader(io.RawIOBase):
+    """A seekable file seen from a start offset, so that offset reads as position 0."""
+    
+    def __init__(self, fp, start):
+        self._fp = fp
+        self._start = start
+    
+    def readable(self):
+        return True
+    
+    def seekable(self):
+        return True
+    
+    def read(self, size=-1):
+        return self._fp.read(size)
+    
+    def readinto(self, buffer):
+        return self._fp.readinto(buffer)
+    
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            if offset < 0:
+                raise ValueError("negative seek position")
+            offset += self._start
+        return max(self._fp.seek(offset, whence) - self._start, 0)
+    
+    def tell(self):
+        return self._fp.tell() - self._start
+
+# One encoded output: main image or a width variant
+WebPOutput = namedtuple("WebPOutput", ["width", "height", "data"])
+
+# What convert_bytes returns; data is None when the size guard skipped the image
+ConversionResult = namedtuple("ConversionResult", [
+    "data", "width", "height", "source_format", "source_width", "source_height", "frames",
+    "input_bytes", "output_bytes", "seconds", "stage_seconds", "peak_memory_bytes", "variants", "skipped",
+])
+
+def convert_bytes(source, max_width=None, max_height=None, encoder=None, preserve_exif=False,
+                  reducing_gap=DEFAULT_REDUCING_GAP, variants=None, events=None, label=None,
+                  measure_memory=False):
+    """Convert an image held in memory to WebP and return a ConversionResult.
+    
+    source is bytes, a memoryview or any other buffer (read in place, not
+    copied), or a binary file object. A seekable file is read in place from
+    its current position, which then counts as the start of the image.
+    Runs the same encode_outputs core as process_image but touches no files.
+    With variants, result.variants lists a WebPOutput per width, largest
+    first, and data is the largest. Errors are raised, not reported as
+    events; events are only emitted to events if it is given, with label
+    (e.g. an upload's name) as their path. peak_memory_bytes is only filled
+    in with measure_memory (see memory_usage).
+    """
+    started = time.perf_counter()
+    if hasattr(source, "read"):
+        if source.seekable():
+            start = source.tell()
+            input_bytes = source.seek(0, io.SEEK_END) - start
+            source.seek(start)
+            fp = OffsetReader(source, start) if start else source
+        else:
+            fp = BufferReader(source.read())
+            input_bytes = len(fp)
+    else:
+        fp = BufferReader(source)
+        input_bytes = len(fp)
+    
+    stage_seconds = {}
+    frames = 1
+    def collect(event):
+        nonlocal frames
+        if event.kind in ("decode", "resize", "encode"):
+            stage_seconds[event.kind] = stage_seconds.get(event.kind, 0.0) + event.seconds
+        if event.kind == "encode" and event.details.get("frames"):
+            frames = event.details["frames"]
+    sink = MultiSink([CallbackSink(collect)])
+    if events is not None:
+        sink.sinks.append(resolve_sink(events))
+    
+    img = Image.open(fp)
+    source_format = img.format
+    source_width, source_height = img.size
+    sizes = target_sizes(source_width, source_height, max_width, max_height, variants)
+    stats = {}
+    outputs = [WebPOutput(width, height, data) for _, (width, height), data in
+               encode_outputs(img, input_bytes, sizes, encoder, preserve_exif, reducing_gap,
+                              "smallest" if variants else None, sink, label, None, stats, measure_memory)]
+    data = outputs[0].data
+    return ConversionResult(
+        data=data,
+        width=outputs[0].width,
+        height=outputs[0].height,
+        source_format=source_format,
+        source_width=source_width,
+        source_height=source_height,
+        frames=frames,
+        input_bytes=input_bytes,
+        output_bytes=len(data) if data is not None else 0,
+        seconds=time.perf_counter() - started,
+        stage_seconds=stage_seconds,
+        peak_memory_bytes=stats.get("peak_memory_bytes"),
+        variants=outputs if variants else [],
+        skipped="larger_than_source" if data is None else None,
+    )
+
+def process_image(img_path, max_width, max_height, delete_original=False, custom_output_dir=None, preserve_structure=True, progress_callback=None, base_directory=None, preserve_exif=False, reducing_gap=DEFAULT_REDUCING_GAP, encoder=None, events=None, variants=None, variant_sidecar=False, measure_memory=False):
+    """Convert one image to WebP and return True on success.
+    
+    Emits decode, resize, encode, write, delete and done events (or an error
+    event) to events; see resolve_sink(). By default they are printed.
+    
+    variants is a list of widths: instead of one output, name-<width>.webp is
+    written for each (capped at max_width and max_height, and nothing is
+    upscaled). The source is decoded once and each size is resized from the
+    next larger one.
+    variant_sidecar also writes name.json listing the variants' sizes.
+    measure_memory adds each stage's memory to its event (see memory_usage).
+    """
+    sink = resolve_sink(events)
+    started_image = time.perf_counter()
+    try:
+        # Step 1: Loading (header only; pixels are decoded on first use)
+        img = Image.open(img_path)
+        width, height = img.size
+        source_bytes = os.path.getsize(img_path)
         
-        if progress_callback:
-            progress_callback(0.6)  # 60% progress after saving PNG
-
-        # Step 4: Convert to WebP
-        webp_filename = os.path.splitext(filename)[0] + ".webp"
-        webp_path = os.path.join(output_dir, webp_filename)
-        save_kwargs = {}
-        if preserve_exif and exif_data is not None:
-            save_kwargs['exif'] = exif_data
-        img.save(webp_path, "WEBP", **save_kwargs)
-        print(f"Converted image to WebP: {webp_filename}")
+        # Determine where to save the files, and at which sizes (None keeps the source size)
+        webp_path = get_output_path(img_path, custom_output_dir, preserve_structure, base_directory)
+        os.makedirs(os.path.dirname(webp_path) or ".", exist_ok=True)
+        sizes = target_sizes(width, height, max_width, max_height, variants)
+        paths = output_paths(webp_path, variants)
+        
+        written = []
+        stats = {}
+        # Variants keep their smallest encode rather than leave a gap in the set
+        outputs = encode_outputs(img, source_bytes, sizes, encoder, preserve_exif, reducing_gap,
+                                 "smallest" if variants else None, sink, img_path, progress_callback, stats,
+                                 measure_memory)
+        for index, (output_width, output_height), data in outputs:
+            output_path = paths[index]
+            if data is None:
+                # The size guard found nothing smaller than the source
+                sink.emit(Event("skip", img_path, reason="larger_than_source", output=output_path))
+                continue
+            
+            # Step 4: Write it via a temp file renamed into place
+            started = time.perf_counter()
+            with atomic_open(output_path) as f:
+                f.write(data)
+            sink.emit(Event("write", img_path, time.perf_counter() - started, output_bytes=len(data), output=output_path))
+            written.append((output_path, output_width, output_height, len(data)))
+        
+        if not written:
+            # Nothing worth writing; the source stays as it is
+            if progress_callback:
+                progress_callback(1.0)
+            return True
+        
+        if variants and variant_sidecar:
+            sidecar = {
+                "width": width,
+                "height": height,
+                "variants": [{"file": os.path.basename(path), "width": w, "height": h, "bytes": size}
+                             for path, w, h, size in reversed(written)],
+            }
+            with atomic_open(sidecar_path(webp_path), "w", encoding="utf-8") as f:
+                json.dump(sidecar, f, indent=1)
         
         if progress_callback:
             progress_callback(0.8)  # 80% progress after WebP conversion
 
-        # Step 5: Cleanup - Delete resized PNG file
-        os.remove(new_path)
-        print(f"Deleted resized image: {new_filename}")
-        
         # Delete original file if option is selected
         if delete_original:
             os.remove(img_path)
-            print(f"Deleted original image: {filename}")
+            sink.emit(Event("delete", img_path, input_bytes=source_bytes))
+        
+        output_bytes = sum(size for _, _, _, size in written)
+        details = {"outputs": [path for path, _, _, _ in written]} if variants else {}
+        rss = max_rss_bytes()
+        if rss is not None:
+            details["max_rss_bytes"] = rss
+        sink.emit(Event("done", img_path, time.perf_counter() - started_image, width * height,
+                        source_bytes, output_bytes, output=written[0][0], **stats, **details))
         
         if progress_callback:
             progress_callback(1.0)  # 100% progress after cleanup
@@ -128,48 +1810,884 @@ def process_image(img_path, max_width, max_height, delete_original=False, custom
         return True
     
     except Exception as e:
-        print(f"An error occurred while processing image {filename}: {e}")
+        sink.emit(Event("error", img_path, time.perf_counter() - started_image,
+                        error=str(e), error_type=type(e).__name__, traceback=traceback.format_exc()))
         return False
 
-def resize_and_convert(directory, max_width, max_height, delete_original=False, process_subdirs=False, use_custom_output=False, custom_output_dir=None, preserve_structure=True, progress_callback=None, preserve_exif=False):
-    image_count = count_images(directory, process_subdirs)
-    if image_count == 0:
-        print("No optimizable images found.")
-        return
+def timed_process_image(**job):
+    """Run process_image and return (result, elapsed seconds)."""
+    start = time.perf_counter()
+    result = process_image(**job)
+    return result, time.perf_counter() - start
 
-    print(f"Processing images in directory: {directory}")
-    print(f"Using max width: {max_width}, max height: {max_height}")
-    print(f"Processing subdirectories: {'Yes' if process_subdirs else 'No'}")
+def process_image_collecting(**job):
+    """Worker-side process_image that returns (result, elapsed seconds, events).
     
-    if use_custom_output and custom_output_dir:
-        print(f"Saving all WebP images to: {custom_output_dir}")
-        print(f"Preserving folder structure: {'Yes' if preserve_structure else 'No'}")
-        # Create output directory if it doesn't exist
-        os.makedirs(custom_output_dir, exist_ok=True)
+    Sinks generally can't cross the process boundary, so events are collected
+    here and re-emitted by the parent.
+    """
+    collected = []
+    result, seconds = timed_process_image(**dict(job, events=collected.append))
+    return result, seconds, collected
+
+def resolve_workers(workers):
+    """Turn a requested worker count into a usable one (None means one per CPU)."""
+    if workers is None:
+        workers = os.cpu_count() or 1
+    return max(1, int(workers))
+
+def run_parallel(jobs, workers, progress_callback=None, events=None, memory_budget=None):
+    """Run process_image keyword-argument jobs across a process pool.
+    
+    jobs may be a lazy iterable; it is consumed as workers free up. Returns
+    (job, result, seconds) triples in job order. The progress callback and
+    event sink cannot cross the process boundary, so workers run without them;
+    here each finished image's events are re-emitted and progress_callback(1.0)
+    fires.
+    
+    With memory_budget (bytes), a job only starts once the estimated peak
+    memory of everything in flight (see estimate_job_memory) leaves room for
+    it; a job bigger than the whole budget runs on its own.
+    """
+    sink = resolve_sink(events)
+    # Filled in as futures finish; a finished future and its events are dropped
+    results = []
+    submitted = {}
+    pending = set()
+    # Keep a bounded number of jobs in flight so huge folders don't queue every
+    # argument tuple in the pool at once
+    max_pending = workers * 4
+    estimates = {}
+    in_flight = 0
+
+    def drain(return_when):
+        nonlocal in_flight
+        done, still_pending = wait(pending, return_when=return_when)
+        for future in done:
+            in_flight -= estimates.pop(future, 0)
+            index = submitted.pop(future)
+            job = results[index][0]
+            try:
+                result, seconds, collected = future.result()
+            except Exception as e:
+                # The worker itself failed (e.g. it was killed); process_image never returned
+                sink.emit(Event("error", job["img_path"], error=str(e), error_type=type(e).__name__))
+                result, seconds, collected = False, 0.0, []
+            for event in collected:
+                sink.emit(event)
+            results[index] = (job, result, seconds)
+            if progress_callback:
+                progress_callback(1.0)
+        return still_pending
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for job in jobs:
+            job = dict(job, progress_callback=None, events=None)
+            estimate = 0
+            if memory_budget:
+                try:
+                    estimate = estimate_job_memory(job)
+                except Exception:
+                    pass  # Unreadable; process_image will report it
+                while pending and in_flight + estimate > memory_budget:
+                    pending = drain(FIRST_COMPLETED)
+            future = executor.submit(process_image_collecting, **job)
+            estimates[future] = estimate
+            in_flight += estimate
+            submitted[future] = len(results)
+            results.append((job, None, None))
+            pending.add(future)
+            if len(pending) >= max_pending:
+                pending = drain(FIRST_COMPLETED)
+        while pending:
+            pending = drain(FIRST_COMPLETED)
+    return results
+
+def resize_and_convert(directory, max_width, max_height, delete_original=False, process_subdirs=False, use_custom_output=False, custom_output_dir=None, preserve_structure=True, progress_callback=None, preserve_exif=False, workers=1, reducing_gap=DEFAULT_REDUCING_GAP, incremental=False, scan_callback=None, dedup=False, encoder=None, events=None, variants=None, variant_sidecar=False, memory_budget=None, dry_run=False, skip_smaller_than=None, journal=None, durability="flush", resume=False, shard=None, measure_memory=False):
+    """Convert every image in directory to WebP and return a summary dict.
+    
+    dry_run only plans: each source's header is read (see plan_image), a plan
+    event is emitted per file and the estimated work is summarised; nothing
+    is decoded or written. skip_smaller_than skips sources that are already
+    within the limits and smaller than that many bytes, before decoding them.
+    
+    journal (True for JOURNAL_FILENAME in the output root, or a path) records
+    each finished item in a JobJournal at the given durability; originals are
+    then deleted only after their outputs are committed to it. resume skips
+    the items an earlier run with the same settings journaled as finished.
     
-    processed_count = 0
+    shard=(index, count) converts only the sources shard_of assigns to index,
+    so count nodes can split a tree with no coordination. Manifest and journal
+    get per-shard names, each shard writes a report, and merge_shards combines
+    them. Duplicates are only found within a shard.
+    
+    measure_memory reports each stage's memory in its events (see
+    memory_usage); it is off by default as it resets the process's peak RSS.
+    """
+    started_at = time.perf_counter()
+    if shard is not None and not 0 <= shard[0] < shard[1]:
+        raise ValueError(f"Shard index must be between 0 and {shard[1] - 1}, got {shard[0]}")
+    encoder = resolve_encoder(encoder)
+    workers = resolve_workers(workers)
+    
+    # Count size guard decisions as events arrive (from workers too)
+    guard_counts = {}
+    guard_skipped = set()
+    def count_guard(event):
+        if event.kind == "encode" and event.details.get("guard"):
+            decision = event.details["guard"]
+            guard_counts[decision] = guard_counts.get(decision, 0) + 1
+        elif event.kind == "skip" and event.details.get("reason") == "larger_than_source":
+            guard_skipped.add(event.path)
+    sink = MultiSink([resolve_sink(events), CallbackSink(count_guard)])
+    
+    # Create output directory if it doesn't exist
+    if use_custom_output and custom_output_dir and not dry_run:
+        os.makedirs(custom_output_dir, exist_ok=True)
     
     # Use the input directory as the base for relative paths
     base_directory = directory
+    output_dir = custom_output_dir if use_custom_output else None
+    output_root = output_dir or directory
+    
+    def relative(path, root=base_directory):
+        return os.path.relpath(path, root).replace(os.sep, "/")
+    
+    def state_path(filename):
+        """Path of a state file in the output root, named per shard when sharding."""
+        return os.path.join(output_root, shard_filename(filename, shard) if shard else filename)
     
-    if process_subdirs:
-        # Process all subdirectories
-        for root, dirs, files in os.walk(directory):
-            for filename in files:
-                if filename.lower().endswith((".png", ".jpg", ".jpeg", ".gif", ".bmp", ".heic", ".tiff", ".tif")):
-                    img_path = os.path.join(root, filename)
-                    if process_image(img_path, max_width, max_height, delete_original, 
-                                     custom_output_dir if use_custom_output else None, 
-                                     preserve_structure, progress_callback, base_directory, preserve_exif):
-                        processed_count += 1
+    def finish(summary):
+        if shard is not None and not dry_run:
+            report = {
+                "shard": list(shard),
+                "settings": conversion_settings(max_width, max_height, preserve_exif, reducing_gap, encoder,
+                                                variants, variant_sidecar),
+                "summary": summary,
+                "seconds": round(time.perf_counter() - started_at, 3),
+                "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            }
+            with atomic_open(state_path(REPORT_FILENAME), "w", encoding="utf-8") as f:
+                json.dump(report, f, indent=2)
+        sink.emit(Event("summary", directory, time.perf_counter() - started_at, summary=summary, dry_run=dry_run,
+                        threshold=skip_smaller_than))
+        return summary
+    
+    def outputs_of(img_path):
+        return output_paths(get_output_path(img_path, output_dir, preserve_structure, base_directory),
+                            variants, variant_sidecar)
+    
+    # Journal: one line per finished item, so an interrupted run can resume
+    journal_writer = None
+    journal_note = None
+    pending_deletes = []
+    finished = {}
+    # Source size and mtime per scanned path, journaled so resume can spot changed sources
+    source_stats = {}
+    
+    def unchanged(record, size, mtime_ns):
+        return record.get("size") == size and record.get("mtime_ns") == mtime_ns
+    
+    if journal and not dry_run:
+        journal_path = state_path(JOURNAL_FILENAME) if journal is True else journal
+        journal_settings = dict(conversion_settings(max_width, max_height, preserve_exif, reducing_gap, encoder,
+                                                    variants, variant_sidecar), delete_original=bool(delete_original))
+        resuming = False
+        if resume:
+            previous_settings, records, deleted, complete = read_journal(journal_path)
+            resuming = previous_settings == journal_settings and not complete
+            if complete:
+                journal_note = "The journaled run finished; starting a new journal"
+            elif previous_settings is not None and not resuming:
+                journal_note = "Journal was written with different settings; starting over"
+        journal_writer = JobJournal(journal_path, durability, append=resuming)
+        if resuming:
+            finished = {path: record for path, record in records.items() if record["status"] in ("done", "skipped")}
+            journal_note = f"Resuming: {len(finished)} items were finished by the interrupted run"
+            if delete_original:
+                # Finish deletions the interrupted run committed to but didn't get to
+                for rel_path, record in records.items():
+                    source_path = os.path.join(base_directory, *rel_path.split("/"))
+                    try:
+                        stat = os.stat(source_path)
+                    except OSError:
+                        continue
+                    if (record["status"] == "done" and rel_path not in deleted
+                            and unchanged(record, stat.st_size, stat.st_mtime_ns)
+                            and all(os.path.exists(path) for path in outputs_of(source_path))):
+                        pending_deletes.append((rel_path, source_path))
+        else:
+            journal_writer.write({"status": "run", "settings": journal_settings, "time": time.time()})
+    
+    sink.emit(Event("run", directory, max_width=max_width, max_height=max_height,
+                    variants=sorted(set(variants)) if variants else None, process_subdirs=process_subdirs,
+                    encoder=str(encoder), shard=shard, output_dir=custom_output_dir if use_custom_output else None,
+                    preserve_structure=preserve_structure, workers=workers, memory_budget=memory_budget,
+                    dry_run=dry_run, journal=journal_note))
+    for rel_path, source_path in pending_deletes:
+        os.remove(source_path)
+        journal_writer.record(rel_path, "deleted")
+        sink.emit(Event("delete", source_path))
+    
+    def commit_done(img_path):
+        """Journal img_path as done once its outputs are durable, then delete its original if asked."""
+        if durability == "fsync":
+            for path in outputs_of(img_path):
+                sync_file(path)
+        size, mtime_ns = source_stats.get(img_path, (None, None))
+        journal_writer.record(relative(img_path), "done", size=size, mtime_ns=mtime_ns,
+                              outputs=[relative(path, output_root) for path in outputs_of(img_path)])
+    
+    def delete_committed(img_path):
+        os.remove(img_path)
+        if journal_writer is not None:
+            journal_writer.record(relative(img_path), "deleted")
+        sink.emit(Event("delete", img_path))
+    
+    def journal_event(event):
+        if event.kind == "done":
+            commit_done(event.path)
+            if delete_original and not dedup:
+                try:
+                    delete_committed(event.path)
+                except OSError as e:
+                    sink.emit(Event("error", event.path, error=str(e), error_type=type(e).__name__))
+        elif event.kind == "error" and event.path and event.details.get("stage") != "scan":
+            journal_writer.record(relative(event.path), "failed", error=event.details.get("error"))
+        elif event.kind == "skip" and event.details.get("reason") in ("up_to_date", "small", "larger_than_source"):
+            size, mtime_ns = source_stats.get(event.path, (None, None))
+            journal_writer.record(relative(event.path), "skipped", reason=event.details["reason"], size=size,
+                                  mtime_ns=mtime_ns)
+    
+    # The scan runs ahead on a helper thread; processing starts with the first file
+    image_count = 0
+    def on_found(count):
+        nonlocal image_count
+        image_count = count
+        if scan_callback:
+            scan_callback(count)
+    if journal_writer is not None:
+        sink.sinks.append(CallbackSink(journal_event))
+    # Unreadable files and folders are reported, not fatal
+    scan_errors = 0
+    def scan_error(path, error):
+        nonlocal scan_errors
+        scan_errors += 1
+        sink.emit(Event("error", path, error=str(error), error_type=type(error).__name__, stage="scan"))
+    def scan_with_events():
+        for item in scan_images(directory, process_subdirs, scan_error):
+            if shard is not None and shard_of(item.rel_path, shard[1]) != shard[0]:
+                continue
+            if journal_writer is not None:
+                source_stats[item.path] = (item.size, item.mtime_ns)
+            sink.emit(Event("scan", item.path, input_bytes=item.size, rel_path=item.rel_path))
+            yield item
+    items = iter_in_background(scan_with_events(), on_found)
+    
+    manifest = None
+    sources = {}
+    skipped_count = 0
+    if incremental:
+        manifest_path = state_path(MANIFEST_FILENAME)
+        if shard is not None and not os.path.exists(manifest_path):
+            # First run with this shard count: start from the merged manifest's entries for this shard
+            manifest = load_manifest(os.path.join(output_root, MANIFEST_FILENAME))
+            manifest["entries"] = {rel_path: entry for rel_path, entry in manifest["entries"].items()
+                                   if shard_of(rel_path, shard[1]) == shard[0]}
+        else:
+            manifest = load_manifest(manifest_path)
+        settings = conversion_settings(max_width, max_height, preserve_exif, reducing_gap, encoder, variants,
+                                       variant_sidecar)
+    
+    # Dedup state: sources seen per size, and the first source seen per content hash
+    seen_by_size = {}
+    primaries = {}
+    duplicates = []
+    
+    def find_primary(item, digest=None):
+        """Return the path of an earlier identical source, or None if item is the first copy."""
+        same_size = seen_by_size.setdefault(item.size, [])
+        if same_size:
+            # Sizes collide: hash any earlier same-size sources that aren't hashed yet
+            for index, (seen_path, seen_digest) in enumerate(same_size):
+                if seen_digest is None:
+                    seen_digest = file_digest(seen_path)
+                    same_size[index] = (seen_path, seen_digest)
+                    primaries.setdefault(seen_digest, seen_path)
+            digest = digest or file_digest(item.path)
+            if digest in primaries:
+                return primaries[digest]
+            primaries[digest] = item.path
+        elif digest is not None:
+            primaries.setdefault(digest, item.path)
+        same_size.append((item.path, digest))
+        return None
+    
+    planned = []
+    small_count = 0
+    resumed_count = 0
+    # With dedup or a journal, originals are deleted here rather than by the workers
+    defer_delete = dedup or journal_writer is not None
+    
+    def skip(img_path, **details):
+        # Skipped sources count towards the total, so they advance progress too
+        sink.emit(Event("skip", img_path, **details))
+        if progress_callback:
+            progress_callback(1.0)
+    
+    def iter_jobs():
+        nonlocal skipped_count, small_count, resumed_count
+        for item in items:
+            record = finished.get(item.rel_path.replace(os.sep, "/")) if finished else None
+            if record is not None and unchanged(record, item.size, item.mtime_ns):
+                resumed_count += 1
+                skip(item.path, reason="journal")
+                continue
+            if manifest is not None:
+                # Skip sources whose manifest entry still matches size, mtime/hash and settings
+                rel_path = item.rel_path.replace(os.sep, "/")
+                output_path = output_paths(get_output_path(item.path, output_dir, preserve_structure, base_directory),
+                                           variants, variant_sidecar)[0]
+                entry = manifest["entries"].get(rel_path)
+                up_to_date, digest = is_up_to_date(entry, item, settings, output_path)
+                if up_to_date:
+                    # Content unchanged; refresh the mtime so the next check is stat-only
+                    entry["mtime_ns"] = item.mtime_ns
+                    skipped_count += 1
+                    skip(item.path, reason="up_to_date")
+                    continue
+                if not dry_run:
+                    # Hash before processing: delete_original may remove the source
+                    sources[item.path] = {
+                        "size": item.size,
+                        "mtime_ns": item.mtime_ns,
+                        "sha256": digest or file_digest(item.path),
+                        "settings": settings,
+                        "output": os.path.relpath(output_path, output_root).replace(os.sep, "/"),
+                    }
+            if dry_run or (skip_smaller_than and item.size < skip_smaller_than):
+                # Header-only planning; only small files need it outside dry runs
+                try:
+                    entry = plan_image(item.path, max_width, max_height, reducing_gap, encoder, variants,
+                                       skip_smaller_than)
+                except Exception as e:
+                    entry = {"path": item.path, "action": "error", "error": str(e)}
+                if dry_run:
+                    planned.append(entry)
+                    sink.emit(Event("plan", item.path, entry.get("estimated_seconds"),
+                                    input_bytes=item.size, **{k: v for k, v in entry.items() if k != "path"}))
+                    continue
+                if entry["action"] == "skip":
+                    small_count += 1
+                    sources.pop(item.path, None)
+                    skip(item.path, reason="small", threshold=skip_smaller_than)
+                    continue
+            if dedup and not dry_run:
+                primary_path = find_primary(item, sources.get(item.path, {}).get("sha256"))
+                if primary_path is not None:
+                    # Filled from the primary's output once that has been encoded
+                    duplicates.append((item.path, primary_path))
+                    skip(item.path, reason="duplicate", duplicate_of=primary_path)
+                    continue
+            # With dedup, originals are deleted only after duplicates have been filled
+            yield dict(img_path=item.path, max_width=max_width, max_height=max_height,
+                       delete_original=delete_original and not defer_delete, custom_output_dir=output_dir,
+                       preserve_structure=preserve_structure, progress_callback=progress_callback,
+                       base_directory=base_directory, preserve_exif=preserve_exif,
+                       reducing_gap=reducing_gap, encoder=encoder, events=sink, variants=variants,
+                       variant_sidecar=variant_sidecar, measure_memory=measure_memory)
+    
+    if dry_run:
+        results = list(iter_jobs())  # Planning only; no jobs are yielded
+    elif workers > 1:
+        results = run_parallel(iter_jobs(), workers, progress_callback, sink, memory_budget)
     else:
-        # Process only the selected directory
-        for filename in os.listdir(directory):
-            if filename.lower().endswith((".png", ".jpg", ".jpeg", ".gif", ".bmp", ".heic", ".tiff", ".tif")):
-                img_path = os.path.join(directory, filename)
-                if process_image(img_path, max_width, max_height, delete_original, 
-                                 custom_output_dir if use_custom_output else None, 
-                                 preserve_structure, progress_callback, base_directory, preserve_exif):
+        results = [(job,) + timed_process_image(**job) for job in iter_jobs()]
+    
+    if image_count == 0:
+        if journal_writer is not None:
+            journal_writer.write({"status": "complete", "time": time.time()})
+            journal_writer.close()
+        summary = {"found": 0, "processed": 0, "failed": 0, "skipped": 0}
+        if scan_errors:
+            summary["scan_errors"] = scan_errors
+        return finish(summary)
+    
+    if dry_run:
+        return finish(summarize_plan(planned, image_count, skipped_count, workers))
+    
+    outcomes = [(job["img_path"], result) for job, result, _ in results]
+    
+    if duplicates:
+        # Fill duplicate outputs from their primary's encode instead of re-encoding
+        encoded = {job["img_path"]: (result, seconds) for job, result, seconds in results}
+        saved_seconds = 0.0
+        saved_bytes = 0
+        for img_path, primary_path in duplicates:
+            primary_ok, primary_seconds = encoded.get(primary_path, (False, 0.0))
+            if not primary_ok:
+                outcomes.append((img_path, False))
+                continue
+            if primary_path in guard_skipped:
+                # Identical content, so the guard's verdict applies too
+                sink.emit(Event("skip", img_path, reason="larger_than_source", duplicate_of=primary_path))
+                outcomes.append((img_path, True))
+                continue
+            # Only the WebPs are shared; the sidecar names the duplicate's own files
+            src_webp = get_output_path(primary_path, output_dir, preserve_structure, base_directory)
+            dst_webp = get_output_path(img_path, output_dir, preserve_structure, base_directory)
+            src_paths = output_paths(src_webp, variants)
+            dst_paths = output_paths(dst_webp, variants)
+            try:
+                for src, dst in zip(src_paths, dst_paths):
+                    if os.path.abspath(src) == os.path.abspath(dst):
+                        continue
+                    os.makedirs(os.path.dirname(dst) or ".", exist_ok=True)
+                    started = time.perf_counter()
+                    method = link_or_copy(src, dst)
+                    output_bytes = os.path.getsize(dst)
+                    if method != "copy":
+                        saved_bytes += output_bytes
+                    sink.emit(Event("write", img_path, time.perf_counter() - started, output_bytes=output_bytes,
+                                    output=dst, reused_from=primary_path, method=method))
+                if variants and variant_sidecar and os.path.abspath(src_webp) != os.path.abspath(dst_webp):
+                    with open(sidecar_path(src_webp), "r", encoding="utf-8") as f:
+                        sidecar = json.load(f)
+                    renamed = {os.path.basename(src): os.path.basename(dst) for src, dst in zip(src_paths, dst_paths)}
+                    for variant in sidecar["variants"]:
+                        variant["file"] = renamed.get(variant["file"], variant["file"])
+                    with atomic_open(sidecar_path(dst_webp), "w", encoding="utf-8") as f:
+                        json.dump(sidecar, f, indent=1)
+                saved_seconds += primary_seconds
+                if journal_writer is not None:
+                    commit_done(img_path)
+                outcomes.append((img_path, True))
+            except OSError as e:
+                sink.emit(Event("error", img_path, error=str(e), error_type=type(e).__name__))
+                outcomes.append((img_path, False))
+    
+    if dedup and delete_original:
+        # Originals go only after every output that depends on them exists
+        for img_path, result in outcomes:
+            if result and img_path not in guard_skipped:
+                delete_committed(img_path)
+    
+    processed_count = sum(1 for _, result in outcomes if result)
+    
+    if manifest is not None:
+        for img_path, result in outcomes:
+            rel_path = os.path.relpath(img_path, base_directory).replace(os.sep, "/")
+            if result and img_path in sources:
+                manifest["entries"][rel_path] = sources[img_path]
+                if img_path in guard_skipped:
+                    manifest["entries"][rel_path]["skipped"] = "larger_than_source"
+            else:
+                # Force a retry next run
+                manifest["entries"].pop(rel_path, None)
+        save_manifest(manifest_path, manifest)
+    
+    if journal_writer is not None:
+        # A later resume starts over instead of trusting this run's records
+        journal_writer.write({"status": "complete", "time": time.time()})
+        journal_writer.close()
+    
+    summary = {
+        "found": image_count,
+        "processed": processed_count,
+        "failed": len(outcomes) - processed_count,
+        "skipped": skipped_count,
+    }
+    if small_count:
+        summary["skipped_small"] = small_count
+    if resumed_count:
+        summary["resumed"] = resumed_count
+    if guard_counts:
+        summary["size_guard"] = dict(guard_counts)
+    if duplicates:
+        summary.update(duplicates=len(duplicates), dedup_saved_seconds=round(saved_seconds, 3),
+                       dedup_saved_bytes=saved_bytes)
+    if scan_errors:
+        summary["scan_errors"] = scan_errors
+    return finish(summary)
+
+class PollingWatcher:
+    """Finds changed and deleted images by rescanning the tree every poll."""
+    
+    name = "polling"
+    
+    def __init__(self, directory, include_subdirs=False, snapshot=None, on_error=None):
+        self.directory = directory
+        self.include_subdirs = include_subdirs
+        self.on_error = on_error
+        self.snapshot = snapshot if snapshot is not None else self.scan()
+    
+    def scan(self):
+        return {item.path: (item.size, item.mtime_ns)
+                for item in scan_images(self.directory, self.include_subdirs, self.on_error)}
+    
+    def poll(self, timeout):
+        """Wait up to timeout seconds and return (changed paths, deleted paths)."""
+        time.sleep(timeout)
+        current = self.scan()
+        changed = [path for path, signature in current.items() if self.snapshot.get(path) != signature]
+        deleted = [path for path in self.snapshot if path not in current]
+        self.snapshot = current
+        return changed, deleted
+    
+    def close(self):
+        pass
+
+class InotifyWatcher:
+    """Linux inotify watcher (needs the inotify_simple package); same interface as PollingWatcher."""
+    
+    name = "inotify"
+    
+    def __init__(self, directory, include_subdirs=False, on_error=None):
+        self.include_subdirs = include_subdirs
+        self.on_error = on_error
+        self.inotify = INotify()
+        self.mask = (inotify_flags.CLOSE_WRITE | inotify_flags.MODIFY | inotify_flags.CREATE |
+                     inotify_flags.MOVED_TO | inotify_flags.DELETE | inotify_flags.MOVED_FROM)
+        self.directories = {}
+        self.add_directory(directory)
+    
+    def add_directory(self, directory):
+        """Watch directory (and its subdirectories when recursive); return the images already in it.
+        
+        Folders that can't be watched are passed to on_error(path, exception),
+        or printed if it is None.
+        """
+        found = []
+        pending_dirs = [directory]
+        while pending_dirs:
+            current = pending_dirs.pop()
+            try:
+                self.directories[self.inotify.add_watch(current, self.mask)] = current
+                with os.scandir(current) as entries:
+                    for entry in entries:
+                        if entry.is_dir(follow_symlinks=False):
+                            if self.include_subdirs:
+                                pending_dirs.append(entry.path)
+                        elif entry.name.lower().endswith(IMAGE_EXTENSIONS):
+                            found.append(entry.path)
+            except OSError as e:
+                if self.on_error is None:
+                    print(f"Could not watch directory {current}: {e}")
+                else:
+                    self.on_error(current, e)
+        return found
+    
+    def poll(self, timeout):
+        changed, deleted = [], []
+        for event in self.inotify.read(timeout=int(timeout * 1000)):
+            if event.mask & inotify_flags.Q_OVERFLOW:
+                # Events were lost: report everything so the caller re-checks it
+                for directory in list(self.directories.values()):
+                    changed.extend(self.add_directory(directory))
+                continue
+            if event.mask & inotify_flags.IGNORED:
+                self.directories.pop(event.wd, None)
+                continue
+            directory = self.directories.get(event.wd)
+            if directory is None or not event.name:
+                continue
+            path = os.path.join(directory, event.name)
+            if event.mask & inotify_flags.ISDIR:
+                # A new (or moved-in) folder may already contain images
+                if self.include_subdirs and event.mask & (inotify_flags.CREATE | inotify_flags.MOVED_TO):
+                    changed.extend(self.add_directory(path))
+            elif event.name.lower().endswith(IMAGE_EXTENSIONS):
+                if event.mask & (inotify_flags.DELETE | inotify_flags.MOVED_FROM):
+                    deleted.append(path)
+                else:
+                    changed.append(path)
+        return changed, deleted
+    
+    def close(self):
+        self.inotify.close()
+
+def create_watcher(directory, include_subdirs=False, use_inotify=None, snapshot=None, sink=None):
+    """Return an InotifyWatcher when possible (or required), else a PollingWatcher.
+    
+    Folders that can't be read or watched, and a fallback to polling, are
+    reported as error events (stage "watch") to sink; see resolve_sink().
+    """
+    sink = resolve_sink(sink)
+    def watch_error(path, error):
+        sink.emit(Event("error", path, error=str(error), error_type=type(error).__name__, stage="watch"))
+    if use_inotify is not False and INotify is not None and sys.platform.startswith("linux"):
+        try:
+            return InotifyWatcher(directory, include_subdirs, watch_error)
+        except OSError as e:
+            if use_inotify:
+                raise
+            sink.emit(Event("error", directory, error=str(e), error_type=type(e).__name__, stage="watch",
+                            fallback="polling"))
+    elif use_inotify:
+        raise RuntimeError("inotify watching requires Linux and inotify_simple. To enable it, run: pip install inotify_simple")
+    return PollingWatcher(directory, include_subdirs, snapshot, watch_error)
+
+def watch_directory(directory, max_width, max_height, delete_original=False, process_subdirs=False, use_custom_output=False, custom_output_dir=None, preserve_structure=True, preserve_exif=False, workers=1, reducing_gap=DEFAULT_REDUCING_GAP, encoder=None, events=None, variants=None, variant_sidecar=False, mirror_deletes=False, process_existing=False, settle_seconds=1.0, poll_interval=2.0, use_inotify=None, stop_event=None, memory_budget=None):
+    """Convert images as they appear or change in directory, until stopped.
+    
+    Uses inotify when available and polls otherwise. A changed file is only
+    processed once its size and mtime have stayed the same for settle_seconds,
+    so files still being copied in are left alone. Images already present are
+    skipped unless process_existing is set. mirror_deletes removes the WebP
+    outputs of sources that are deleted.
+    
+    Runs until stop_event (a threading.Event) is set or Ctrl+C is pressed and
+    returns a summary dict. Like resize_and_convert, it emits a run event
+    (with watch=True) when it starts and a summary event when it stops.
+    """
+    if mirror_deletes and delete_original:
+        raise ValueError("mirror_deletes cannot be combined with delete_original (outputs would be removed)")
+    started_at = time.perf_counter()
+    encoder = resolve_encoder(encoder)
+    base_directory = directory
+    output_dir = custom_output_dir if use_custom_output else None
+    workers = resolve_workers(workers)
+    
+    # Unreadable files and folders are reported, not fatal
+    scan_errors = 0
+    def count_scan_error(event):
+        nonlocal scan_errors
+        if event.kind == "error" and event.details.get("stage") in ("scan", "watch") and not event.details.get("fallback"):
+            scan_errors += 1
+    sink = MultiSink([resolve_sink(events), CallbackSink(count_scan_error)])
+    def scan_error(path, error):
+        sink.emit(Event("error", path, error=str(error), error_type=type(error).__name__, stage="scan"))
+    
+    # Last signature (size, mtime_ns) handled per source, so repeated events don't reprocess
+    known = {item.path: (item.size, item.mtime_ns) for item in scan_images(directory, process_subdirs, scan_error)}
+    # Changed sources waiting to settle: path -> (signature, time first seen with it)
+    pending = {}
+    if process_existing:
+        pending = dict.fromkeys(known)
+        known = {}
+    
+    watcher = create_watcher(directory, process_subdirs, use_inotify, dict(known), sink)
+    sink.emit(Event("run", directory, watch=True, watcher=watcher.name, max_width=max_width, max_height=max_height,
+                    variants=sorted(set(variants)) if variants else None, process_subdirs=process_subdirs,
+                    encoder=str(encoder), output_dir=output_dir, preserve_structure=preserve_structure,
+                    workers=workers, memory_budget=memory_budget, mirror_deletes=mirror_deletes))
+    processed_count = failed_count = removed_count = 0
+    try:
+        while stop_event is None or not stop_event.is_set():
+            # Re-check settling files often; otherwise only wake up to notice stop_event
+            timeout = min(poll_interval, settle_seconds / 2) if pending else poll_interval
+            changed, deleted = watcher.poll(timeout)
+            for path in changed:
+                pending.setdefault(path, None)
+            for path in deleted:
+                pending.pop(path, None)
+                if known.pop(path, None) is None or not mirror_deletes:
+                    continue
+                webp_path = get_output_path(path, output_dir, preserve_structure, base_directory)
+                for output_path in output_paths(webp_path, variants, variant_sidecar):
+                    try:
+                        os.remove(output_path)
+                    except FileNotFoundError:
+                        continue
+                    removed_count += 1
+                    sink.emit(Event("delete", path, output=output_path, mirrored=True))
+            
+            now = time.monotonic()
+            ready = []
+            for path, state in list(pending.items()):
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    del pending[path]
+                    continue
+                signature = (stat.st_size, stat.st_mtime_ns)
+                if state is None or state[0] != signature:
+                    pending[path] = (signature, now)
+                elif now - state[1] >= settle_seconds:
+                    del pending[path]
+                    if known.get(path) != signature:
+                        known[path] = signature
+                        ready.append(path)
+            if not ready:
+                continue
+            
+            jobs = [dict(img_path=path, max_width=max_width, max_height=max_height, delete_original=delete_original,
+                         custom_output_dir=output_dir, preserve_structure=preserve_structure,
+                         base_directory=base_directory, preserve_exif=preserve_exif, reducing_gap=reducing_gap,
+                         encoder=encoder, events=sink, variants=variants, variant_sidecar=variant_sidecar)
+                    for path in ready]
+            if workers > 1 and len(jobs) > 1:
+                results = run_parallel(jobs, workers, events=sink, memory_budget=memory_budget)
+            else:
+                results = [(job,) + timed_process_image(**job) for job in jobs]
+            for job, result, _ in results:
+                if result:
                     processed_count += 1
+                else:
+                    failed_count += 1
+                    # Let a later change retry it
+                    known.pop(job["img_path"], None)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        watcher.close()
     
-    print(f"Successfully processed {processed_count} out of {image_count} images.")
+    summary = {"processed": processed_count, "failed": failed_count, "removed": removed_count}
+    if scan_errors:
+        summary["scan_errors"] = scan_errors
+    sink.emit(Event("summary", directory, time.perf_counter() - started_at, summary=summary, watch=True))
+    return summary
+
+def encoder_from_args(args):
+    """Build EncoderOptions from the command line's encoder arguments."""
+    changes = {}
+    for field in ("quality", "method", "target_size", "target_ssim", "size_guard"):
+        value = getattr(args, field)
+        if value is not None:
+            changes[field] = value
+    if args.lossless:
+        changes["lossless"] = True
+    return EncoderOptions.from_profile(args.profile, **changes)
+
+def convert_stdin_bytes(args, encoder):
+    """Pipe mode: one image's bytes on stdin, its WebP bytes on stdout."""
+    # A pipe must produce an image, so the size guard can't skip here
+    if encoder.size_guard == "skip":
+        encoder = encoder.replace(size_guard="smallest")
+    try:
+        result = convert_bytes(sys.stdin.buffer.read(), args.max_width, args.max_height, encoder, args.preserve_exif,
+                               args.reducing_gap, events=ConsoleSink(sys.stderr) if args.verbose else None,
+                               label="<stdin>")
+    except UnidentifiedImageError:
+        print("Could not convert stdin: not a readable image", file=sys.stderr)
+        return 1
+    except (OSError, ValueError) as e:
+        print(f"Could not convert stdin: {e}", file=sys.stderr)
+        return 1
+    sys.stdout.buffer.write(result.data)
+    sys.stdout.buffer.flush()
+    return 0
+
+def convert_stdin_paths(args, encoder):
+    """Pipe mode: newline-separated paths on stdin, one JSON result line per image on stdout."""
+    results = ResultLinesSink(sys.stdout)
+    sinks = [results]
+    if args.verbose:
+        sinks.append(ConsoleSink(sys.stderr))
+    if args.events:
+        sinks.append(JsonLinesSink(args.events))
+    sink = MultiSink(sinks)
+    cwd = os.getcwd()
+    
+    def iter_jobs():
+        for line in sys.stdin:
+            path = line.rstrip("\r\n")
+            if not path:
+                continue
+            path = os.path.abspath(path)
+            # Keep the layout under the working directory; anything else goes flat into --output
+            base_directory = cwd if path.startswith(cwd + os.sep) else os.path.dirname(path)
+            yield dict(img_path=path, max_width=args.max_width, max_height=args.max_height,
+                       delete_original=args.delete_original, custom_output_dir=args.output,
+                       base_directory=base_directory, preserve_exif=args.preserve_exif,
+                       reducing_gap=args.reducing_gap, encoder=encoder, events=sink,
+                       variants=args.variants, variant_sidecar=args.sidecar)
+    
+    workers = resolve_workers(args.workers)
+    if workers > 1:
+        run_parallel(iter_jobs(), workers, events=sink, memory_budget=args.memory_budget)
+    else:
+        for job in iter_jobs():
+            process_image(**job)
+    return 1 if results.failed else 0
+
+def shard_arg(spec):
+    try:
+        return parse_shard(spec)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Resize and convert images to WebP.",
+        epilog="Pipe modes: 'opti_webp.py - < in.jpg > out.webp' converts one image's bytes; "
+               "'find . -name \"*.jpg\" | opti_webp.py --stdin-paths' converts each listed file and "
+               "prints one JSON result per line. Logs go to stderr with -v.")
+    parser.add_argument("directory", nargs="?", help="folder to convert, or - to convert stdin bytes to stdout")
+    parser.add_argument("--stdin-paths", action="store_true", help="read image paths from stdin, print JSON results")
+    parser.add_argument("--max-width", type=int, default=None)
+    parser.add_argument("--max-height", type=int, default=None)
+    parser.add_argument("--subdirs", action="store_true", help="include subfolders")
+    parser.add_argument("--output", help="write WebPs here instead of next to the sources")
+    parser.add_argument("--flat", action="store_true", help="don't recreate subfolders under --output")
+    parser.add_argument("--delete-original", action="store_true")
+    parser.add_argument("--preserve-exif", action="store_true")
+    parser.add_argument("--workers", type=int, default=1, help="worker processes (0 = one per CPU)")
+    parser.add_argument("--reducing-gap", type=float, default=DEFAULT_REDUCING_GAP)
+    parser.add_argument("--profile", default="balanced", choices=list(EncoderOptions.PROFILES))
+    parser.add_argument("--quality", type=int)
+    parser.add_argument("--method", type=int, choices=range(7))
+    parser.add_argument("--lossless", action="store_true")
+    parser.add_argument("--target-size", type=int, help="byte budget per image")
+    parser.add_argument("--target-ssim", type=float, help="auto quality: lowest quality reaching this SSIM")
+    parser.add_argument("--size-guard", choices=["smallest", "skip"], help="handle outputs larger than the source")
+    parser.add_argument("--variants", type=int, nargs="+", metavar="WIDTH", help="write name-<width>.webp per width (capped at --max-width)")
+    parser.add_argument("--sidecar", action="store_true", help="with --variants, write name.json")
+    parser.add_argument("--incremental", action="store_true")
+    parser.add_argument("--dedup", action="store_true")
+    parser.add_argument("--dry-run", action="store_true")
+    parser.add_argument("--skip-smaller-than", type=int, metavar="BYTES")
+    parser.add_argument("--memory-budget", type=int, metavar="MB")
+    parser.add_argument("--journal", action="store_true", help="journal finished images (see --resume)")
+    parser.add_argument("--resume", action="store_true", help="continue an interrupted journaled run")
+    parser.add_argument("--durability", default="flush", choices=JobJournal.DURABILITY_LEVELS)
+    parser.add_argument("--shard", type=shard_arg, metavar="INDEX/COUNT",
+                        help="convert only this node's part of the tree (0-based INDEX)")
+    parser.add_argument("--merge-shards", action="store_true",
+                        help="combine the shard reports and manifests in DIRECTORY into one summary")
+    parser.add_argument("--watch", action="store_true", help="keep converting new and changed images")
+    parser.add_argument("--events", help="append JSON events to this file")
+    parser.add_argument("--measure-memory", action="store_true", help="report each stage's memory in events")
+    parser.add_argument("-v", "--verbose", action="store_true", help="log to stderr in pipe modes")
+    args = parser.parse_args(argv)
+    if args.workers == 0:
+        args.workers = None
+    if args.memory_budget:
+        args.memory_budget *= 1024 ** 2
+    encoder = encoder_from_args(args)
+    
+    if args.directory == "-":
+        return convert_stdin_bytes(args, encoder)
+    if args.stdin_paths:
+        return convert_stdin_paths(args, encoder)
+    if not args.directory:
+        parser.error("a directory, - or --stdin-paths is required")
+    if args.merge_shards:
+        try:
+            summary = merge_shards(args.directory, args.shard[1] if args.shard else None)
+        except (OSError, ValueError) as e:
+            print(f"Could not merge shards: {e}", file=sys.stderr)
+            return 2
+        print(json.dumps(summary, indent=2))
+        return 1 if summary.get("failed") or summary.get("missing_shards") else 0
+    
+    events = [ConsoleSink()]
+    if args.events:
+        events.append(JsonLinesSink(args.events))
+    options = dict(delete_original=args.delete_original, process_subdirs=args.subdirs,
+                   use_custom_output=bool(args.output), custom_output_dir=args.output,
+                   preserve_structure=not args.flat, preserve_exif=args.preserve_exif, workers=args.workers,
+                   reducing_gap=args.reducing_gap, encoder=encoder, events=events, variants=args.variants,
+                   variant_sidecar=args.sidecar, memory_budget=args.memory_budget)
+    if args.watch:
+        watch_directory(args.directory, args.max_width, args.max_height, **options)
+        return 0
+    summary = resize_and_convert(args.directory, args.max_width, args.max_height, incremental=args.incremental,
+                                 dedup=args.dedup, dry_run=args.dry_run, skip_smaller_than=args.skip_smaller_than,
+                                 journal=args.journal or args.resume, durability=args.durability,
+                                 resume=args.resume, shard=args.shard, measure_memory=args.measure_memory,
+                                 **options)
+    return 1 if summary.get("failed") else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
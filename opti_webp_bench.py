@@ -0,0 +1,209 @@
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import platform
+import tempfile
+from PIL import Image, ImageDraw, ImageFilter
+import PIL
+import opti_webp
+
+# Corpus image sizes per scale; the "large" scale also gets TIFF scans
+CORPUS_SIZES = {
+    "small": [(640, 480), (800, 1200)],
+    "medium": [(1920, 1280), (1200, 1800), (2560, 1440)],
+    "large": [(4000, 3000), (6000, 4000)],
+}
+
+# Configurations run by default: (name, workers, encoder profile)
+DEFAULT_CONFIGS = [
+    ("fast-1w", 1, "fast"),
+    ("balanced-1w", 1, "balanced"),
+    ("smallest-1w", 1, "smallest"),
+    ("balanced-all", None, "balanced"),
+]
+
+STAGES = ("decode", "resize", "encode", "write")
+
+def photo_like(rng, size):
+    """Smooth colour blobs with fine grain, roughly the statistics of a photograph."""
+    width, height = size
+    base_size = (max(2, width // 32), max(2, height // 32))
+    base = Image.frombytes("RGB", base_size, rng.randbytes(base_size[0] * base_size[1] * 3))
+    base = base.resize(size, Image.BICUBIC).filter(ImageFilter.GaussianBlur(radius=max(1, width // 200)))
+    grain = Image.frombytes("L", size, rng.randbytes(width * height)).convert("RGB")
+    return Image.blend(base, grain, 0.12)
+
+def flat_with_alpha(rng, size):
+    """Flat-colour shapes on a transparent background, like logos and UI assets."""
+    img = Image.new("RGBA", size, (0, 0, 0, 0))
+    draw = ImageDraw.Draw(img)
+    width, height = size
+    for _ in range(12):
+        x0, y0 = rng.randrange(width), rng.randrange(height)
+        x1, y1 = rng.randrange(x0, width + 1), rng.randrange(y0, height + 1)
+        colour = tuple(rng.randrange(256) for _ in range(3)) + (rng.randrange(64, 256),)
+        if rng.random() < 0.5:
+            draw.rectangle([x0, y0, x1, y1], fill=colour)
+        else:
+            draw.ellipse([x0, y0, x1, y1], fill=colour)
+    return img
+
+def animation(rng, size, frame_count=12):
+    """A square moving across a flat background, with a few repeated frames."""
+    width, height = size
+    background = tuple(rng.randrange(256) for _ in range(3))
+    colour = tuple(rng.randrange(256) for _ in range(3))
+    side = max(4, min(size) // 4)
+    frames = []
+    for index in range(frame_count):
+        # Every third frame repeats the previous one
+        position = index - index // 3
+        frame = Image.new("RGB", size, background)
+        x = (position * width // frame_count) % max(1, width - side)
+        ImageDraw.Draw(frame).rectangle([x, height // 3, x + side, height // 3 + side], fill=colour)
+        frames.append(frame.convert("P", palette=Image.ADAPTIVE))
+    return frames
+
+def generate_corpus(directory, seed=0, count=2, scales=("small", "medium")):
+    """Create a reproducible benchmark corpus and return the number of files written.
+
+    For every scale and size, writes count photo-like JPEGs, flat-colour PNGs
+    with alpha and animated GIFs; large TIFFs are added when "large" is listed.
+    The same seed always produces the same files.
+    """
+    rng = random.Random(seed)
+    os.makedirs(directory, exist_ok=True)
+    written = 0
+    for scale in scales:
+        for width, height in CORPUS_SIZES[scale]:
+            for index in range(count):
+                stem = os.path.join(directory, f"{scale}-{width}x{height}-{index}")
+                photo_like(rng, (width, height)).save(stem + "-photo.jpg", quality=90)
+                flat_with_alpha(rng, (width, height)).save(stem + "-flat.png")
+                frames = animation(rng, (width // 4, height // 4))
+                frames[0].save(stem + "-anim.gif", save_all=True, append_images=frames[1:], duration=80, loop=0)
+                written += 3
+                if scale == "large":
+                    photo_like(rng, (width, height)).save(stem + "-scan.tif")
+                    written += 1
+    print(f"Generated {written} corpus images in {directory}")
+    return written
+
+def run_config(corpus_dir, name, workers, profile, max_width, max_height):
+    """Run the real driver (resize_and_convert) over the corpus once and return a result dict.
+
+    Stage times come from the pipeline's own events, re-emitted from the
+    worker processes when workers > 1.
+    """
+    output_dir = tempfile.mkdtemp(prefix="opti-webp-bench-")
+    workers = opti_webp.resolve_workers(workers)
+    metrics = opti_webp.MetricsAggregator()
+    try:
+        started = time.perf_counter()
+        summary = opti_webp.resize_and_convert(corpus_dir, max_width, max_height, process_subdirs=True,
+                                               use_custom_output=True, custom_output_dir=output_dir,
+                                               workers=workers, encoder=profile, events=metrics,
+                                               measure_memory=True)
+        wall = time.perf_counter() - started
+    finally:
+        shutil.rmtree(output_dir, ignore_errors=True)
+
+    stats = metrics.summary()
+    processed = summary["processed"]
+    megapixels = stats["pixels"].get("decode", 0) / 1e6
+    result = {
+        "name": name,
+        "workers": workers,
+        "profile": profile,
+        "images": summary["found"],
+        "processed": processed,
+        "wall_seconds": round(wall, 4),
+        "images_per_second": round(processed / wall, 3) if wall else 0.0,
+        "megapixels_per_second": round(megapixels / wall, 3) if wall else 0.0,
+        "source_bytes": stats["input_bytes"],
+        "output_bytes": stats["output_bytes"],
+        # Summed over images, so with several workers these are CPU-side totals
+        "stage_seconds": {stage: round(stats["seconds"].get(stage, 0.0), 4) for stage in STAGES},
+        "peak_memory_bytes": {stage: stats["peak_memory_bytes"][stage]
+                              for stage in STAGES if stage in stats["peak_memory_bytes"]},
+    }
+    return result
+
+def print_result(result, baseline=None):
+    stages = ", ".join(f"{stage} {seconds:.2f}s" for stage, seconds in result["stage_seconds"].items())
+    line = (f"{result['name']:>14}: {result['images_per_second']:8.2f} img/s  "
+            f"{result['megapixels_per_second']:8.2f} MP/s  [{stages}]")
+    if baseline and baseline.get(result["name"], {}).get("images_per_second"):
+        before = baseline[result["name"]]["images_per_second"]
+        line += f"  ({(result['images_per_second'] - before) / before * 100:+.1f}% vs baseline)"
+    print(line)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the Opti-WebP conversion pipeline on a synthetic corpus.")
+    parser.add_argument("--corpus", help="corpus directory (generated if missing; temporary if omitted)")
+    parser.add_argument("--seed", type=int, default=0, help="corpus random seed")
+    parser.add_argument("--count", type=int, default=2, help="images of each kind per size")
+    parser.add_argument("--scales", nargs="+", default=["small", "medium"], choices=list(CORPUS_SIZES),
+                        help="corpus size classes; 'large' adds big TIFFs")
+    parser.add_argument("--max-width", type=int, default=1200)
+    parser.add_argument("--max-height", type=int, default=1200)
+    parser.add_argument("--config", action="append", metavar="NAME:WORKERS:PROFILE",
+                        help="configuration to run (repeatable); WORKERS may be 'all'")
+    parser.add_argument("--repeat", type=int, default=1, help="runs per configuration (best is kept)")
+    parser.add_argument("--output", help="write results to this JSON file")
+    parser.add_argument("--baseline", help="earlier results JSON to compare against")
+    args = parser.parse_args(argv)
+
+    configs = DEFAULT_CONFIGS
+    if args.config:
+        configs = []
+        for spec in args.config:
+            name, workers, profile = spec.split(":")
+            configs.append((name, None if workers == "all" else int(workers), profile))
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            baseline = {result["name"]: result for result in json.load(f)["results"]}
+
+    temp_corpus = None
+    corpus_dir = args.corpus
+    if not corpus_dir:
+        corpus_dir = temp_corpus = tempfile.mkdtemp(prefix="opti-webp-corpus-")
+    try:
+        if not os.path.isdir(corpus_dir) or not os.listdir(corpus_dir):
+            generate_corpus(corpus_dir, args.seed, args.count, args.scales)
+
+        results = []
+        for name, workers, profile in configs:
+            runs = [run_config(corpus_dir, name, workers, profile, args.max_width, args.max_height)
+                    for _ in range(max(1, args.repeat))]
+            best = max(runs, key=lambda result: result["images_per_second"])
+            results.append(best)
+            print_result(best, baseline)
+    finally:
+        if temp_corpus:
+            shutil.rmtree(temp_corpus, ignore_errors=True)
+
+    if args.output:
+        report = {
+            "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "pillow": PIL.__version__,
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "corpus": {"seed": args.seed, "count": args.count, "scales": args.scales},
+            "max_width": args.max_width,
+            "max_height": args.max_height,
+            "results": results,
+        }
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+        print(f"Saved results to {args.output}")
+
+if __name__ == "__main__":
+    sys.exit(main())
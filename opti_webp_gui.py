@@ -1,10 +1,14 @@
 import os
 import sys
-import glob
 import customtkinter as ctk
 from tkinter import filedialog, messagebox
 from PIL import Image, ImageTk
 import threading
+import queue
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+from collections import OrderedDict
+import multiprocessing
 import importlib.util
 from customtkinter import CTkImage
 import opti_webp
@@ -20,6 +24,8 @@ def resource_path(relative_path):
 ctk.set_appearance_mode("System")
 ctk.set_default_color_theme("blue") 
 HIGHLIGHT_COLOR = "#763ece"
+LOG_MAX_LINES = 1000  # Lines kept in the log box; older lines are dropped
+PROGRESS_FPS = 15  # Progress bar/log repaints per second while processing
 
 class CustomMessageBox(ctk.CTkToplevel):
     def __init__(self, master, title, message, ask=False):
@@ -174,6 +180,138 @@ def custom_askyesno(master, title, message):
     msg_box = CustomMessageBox(master, title, message, ask=True)
     return msg_box.result
 
+def default_thumbnail_cache_dir():
+    """Per-user cache directory for preview thumbnails"""
+    if sys.platform == "win32":
+        base = os.environ.get("LOCALAPPDATA") or os.path.expanduser("~")
+        return os.path.join(base, "Opti-WebP", "thumbnails")
+    base = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(base, "opti-webp", "thumbnails")
+
+class ThumbnailCache:
+    """Two-level thumbnail cache: an in-memory LRU backed by an on-disk store.
+    
+    Entries are keyed by the source's absolute path, size and mtime plus the
+    thumbnail size, so edited files are re-rendered automatically. The memory
+    level is capped by decoded pixel bytes; the disk level by total file size,
+    evicting the least recently used files first.
+    """
+    
+    def __init__(self, cache_dir=None, memory_limit=64 * 1024 * 1024, disk_limit=256 * 1024 * 1024):
+        self.cache_dir = cache_dir or default_thumbnail_cache_dir()
+        self.memory_limit = memory_limit
+        self.disk_limit = disk_limit
+        self._memory = OrderedDict()
+        self._memory_bytes = 0
+        self._disk_bytes = None  # Measured lazily on first write
+        self._lock = threading.Lock()
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+        except OSError as e:
+            print(f"Thumbnail disk cache disabled: {e}")
+            self.cache_dir = None
+    
+    def key(self, image_path, thumbnail_size):
+        stat = os.stat(image_path)
+        identity = f"{os.path.abspath(image_path)}|{stat.st_size}|{stat.st_mtime_ns}|{thumbnail_size}"
+        return hashlib.sha1(identity.encode("utf-8")).hexdigest()
+    
+    def get_or_create(self, image_path, thumbnail_size, render):
+        """Return the cached thumbnail, calling render(image_path) to make it on a miss"""
+        key = self.key(image_path, thumbnail_size)
+        img = self._get_memory(key)
+        if img is None:
+            img = self._get_disk(key)
+            if img is None:
+                img = render(image_path)
+                if img is None:
+                    return None
+                self._put_disk(key, img)
+            self._put_memory(key, img)
+        return img
+    
+    def _get_memory(self, key):
+        with self._lock:
+            img = self._memory.get(key)
+            if img is not None:
+                self._memory.move_to_end(key)
+            return img
+    
+    def _put_memory(self, key, img):
+        size = img.width * img.height * len(img.getbands())
+        with self._lock:
+            if key in self._memory:
+                return
+            self._memory[key] = img
+            self._memory_bytes += size
+            while self._memory_bytes > self.memory_limit and len(self._memory) > 1:
+                _, evicted = self._memory.popitem(last=False)
+                self._memory_bytes -= evicted.width * evicted.height * len(evicted.getbands())
+    
+    def _disk_path(self, key):
+        # Fan out over subdirectories so no single directory gets huge
+        return os.path.join(self.cache_dir, key[:2], key + ".webp")
+    
+    def _get_disk(self, key):
+        if not self.cache_dir:
+            return None
+        path = self._disk_path(key)
+        try:
+            with Image.open(path) as img:
+                img.load()
+            # Mark as recently used for disk eviction
+            os.utime(path)
+            return img
+        except (OSError, ValueError):
+            return None
+    
+    def _put_disk(self, key, img):
+        if not self.cache_dir:
+            return
+        path = self._disk_path(key)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with opti_webp.atomic_open(path) as f:
+                img.save(f, "WEBP", quality=90)
+            written = os.path.getsize(path)
+        except OSError as e:
+            print(f"Could not write thumbnail cache entry: {e}")
+            return
+        with self._lock:
+            if self._disk_bytes is None:
+                self._disk_bytes = sum(size for _, size, _ in self._disk_entries())
+            else:
+                self._disk_bytes += written
+            if self._disk_bytes > self.disk_limit:
+                self._evict_disk()
+    
+    def _disk_entries(self):
+        entries = []
+        for root, dirs, files in os.walk(self.cache_dir):
+            for filename in files:
+                path = os.path.join(root, filename)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((path, stat.st_size, stat.st_mtime))
+        return entries
+    
+    def _evict_disk(self):
+        # Drop least recently used files until well under the limit
+        entries = sorted(self._disk_entries(), key=lambda entry: entry[2])
+        total = sum(size for _, size, _ in entries)
+        target = self.disk_limit * 0.9
+        for path, size, _ in entries:
+            if total <= target:
+                break
+            try:
+                os.remove(path)
+                total -= size
+            except OSError:
+                pass
+        self._disk_bytes = total
+
 class OptiWebpGUI(ctk.CTk):
     def __init__(self):
         super().__init__()
@@ -196,6 +334,12 @@ class OptiWebpGUI(ctk.CTk):
         self.output_directory = ctk.StringVar(value="")
         self.custom_output = ctk.BooleanVar(value=False)
         self.preserve_exif = ctk.BooleanVar(value=False)
+        self.workers = ctk.StringVar(value=str(os.cpu_count() or 1))
+        self.incremental = ctk.BooleanVar(value=False)
+        self.dedup = ctk.BooleanVar(value=False)
+        self.journal = ctk.BooleanVar(value=False)
+        self.encoder_profile = ctk.StringVar(value="balanced")
+        self.lossless_png = ctk.BooleanVar(value=False)
         
         # Link selected_directory to output_directory when custom_output is False
         self.selected_directory.trace_add("write", self._update_output_directory)
@@ -211,8 +355,22 @@ class OptiWebpGUI(ctk.CTk):
         self.progress_value = ctk.DoubleVar(value=0.0)
         self.total_images = 0
         self.processed_images = 0
-        self.preview_images = []  # Store image references
+        self.progress_fraction = 0.0  # Written by the worker thread, painted by the Tk thread
+        self.shown_progress = None  # Last fraction actually painted
+        self.log_queue = queue.Queue()  # Messages from any thread, drained on the Tk thread
         self.thumbnail_size = 150  # Size for preview thumbnails
+        self.thumbnail_cache = ThumbnailCache()
+        
+        # Virtualized preview: every path is known, but only cells in view have labels
+        self.preview_paths = []  # All previewed image paths, in scan order
+        self.preview_labels = {}  # index -> CTkLabel for materialized cells
+        self.preview_pending = set()  # indices queued for background decoding
+        self.preview_failed = set()  # indices whose thumbnail could not be made
+        self.preview_visible = (0, -1)  # first/last index currently in view
+        self.preview_generation = 0  # Bumped whenever the previewed folder changes
+        self.preview_results = queue.Queue()  # Background results for the Tk thread
+        self.preview_update_scheduled = False
+        self.thumbnail_executor = ThreadPoolExecutor(max_workers=min(4, os.cpu_count() or 1))
         
         # Configure main window grid
         self.grid_columnconfigure(0, weight=1)
@@ -359,6 +517,51 @@ class OptiWebpGUI(ctk.CTk):
             hover_color=self.adjust_color_brightness(HIGHLIGHT_COLOR, -20)
         )
         subdirectories_checkbox.grid(row=0, column=0, columnspan=2, padx=0, pady=(0, 0), sticky="w")
+
+        # Skip images that are unchanged since the last run (manifest-based)
+        incremental_checkbox = ctk.CTkCheckBox(
+            checkbox_frame,
+            text="Skip Unchanged Images (Incremental)",
+            variable=self.incremental,
+            checkbox_width=20,
+            checkbox_height=20,
+            corner_radius=4,
+            border_width=2,
+            hover=True,
+            fg_color=HIGHLIGHT_COLOR,
+            hover_color=self.adjust_color_brightness(HIGHLIGHT_COLOR, -20)
+        )
+        incremental_checkbox.grid(row=1, column=0, columnspan=2, padx=0, pady=(10, 0), sticky="w")
+
+        # Encode byte-identical sources once and link the other outputs
+        dedup_checkbox = ctk.CTkCheckBox(
+            checkbox_frame,
+            text="Encode Identical Images Once (Deduplicate)",
+            variable=self.dedup,
+            checkbox_width=20,
+            checkbox_height=20,
+            corner_radius=4,
+            border_width=2,
+            hover=True,
+            fg_color=HIGHLIGHT_COLOR,
+            hover_color=self.adjust_color_brightness(HIGHLIGHT_COLOR, -20)
+        )
+        dedup_checkbox.grid(row=2, column=0, columnspan=2, padx=0, pady=(10, 0), sticky="w")
+
+        # Journal finished images so an interrupted run picks up where it stopped
+        journal_checkbox = ctk.CTkCheckBox(
+            checkbox_frame,
+            text="Resume Interrupted Runs (Keep a Journal)",
+            variable=self.journal,
+            checkbox_width=20,
+            checkbox_height=20,
+            corner_radius=4,
+            border_width=2,
+            hover=True,
+            fg_color=HIGHLIGHT_COLOR,
+            hover_color=self.adjust_color_brightness(HIGHLIGHT_COLOR, -20)
+        )
+        journal_checkbox.grid(row=3, column=0, columnspan=2, padx=0, pady=(10, 0), sticky="w")
         
         # Output directory selection (moved down)
         output_checkbox = ctk.CTkCheckBox(
@@ -431,6 +634,54 @@ class OptiWebpGUI(ctk.CTk):
         )
         preserve_exif_checkbox.grid(row=6, column=0, columnspan=3, padx=20, pady=(0, 10), sticky="w")
 
+        # Number of worker processes used for conversion
+        workers_frame = ctk.CTkFrame(settings_frame, fg_color="transparent")
+        workers_frame.grid(row=7, column=0, columnspan=3, padx=20, pady=(0, 20), sticky="w")
+
+        workers_label = ctk.CTkLabel(workers_frame, text="Worker Processes:", anchor="w")
+        workers_label.grid(row=0, column=0, padx=(0, 10))
+
+        workers_menu = ctk.CTkOptionMenu(
+            workers_frame,
+            values=[str(n) for n in range(1, (os.cpu_count() or 1) + 1)],
+            variable=self.workers,
+            width=80,
+            fg_color=HIGHLIGHT_COLOR,
+            button_color=self.adjust_color_brightness(HIGHLIGHT_COLOR, -20),
+            button_hover_color=self.adjust_color_brightness(HIGHLIGHT_COLOR, -40)
+        )
+        workers_menu.grid(row=0, column=1)
+
+        # Encoder speed/size profile
+        profile_label = ctk.CTkLabel(workers_frame, text="Encoder Profile:", anchor="w")
+        profile_label.grid(row=0, column=2, padx=(20, 10))
+
+        profile_menu = ctk.CTkOptionMenu(
+            workers_frame,
+            values=list(opti_webp.EncoderOptions.PROFILES),
+            variable=self.encoder_profile,
+            width=110,
+            fg_color=HIGHLIGHT_COLOR,
+            button_color=self.adjust_color_brightness(HIGHLIGHT_COLOR, -20),
+            button_hover_color=self.adjust_color_brightness(HIGHLIGHT_COLOR, -40)
+        )
+        profile_menu.grid(row=0, column=3)
+
+        # Per-format override: keep PNG sources lossless
+        lossless_png_checkbox = ctk.CTkCheckBox(
+            workers_frame,
+            text="Lossless for PNG",
+            variable=self.lossless_png,
+            checkbox_width=20,
+            checkbox_height=20,
+            corner_radius=4,
+            border_width=2,
+            hover=True,
+            fg_color=HIGHLIGHT_COLOR,
+            hover_color=self.adjust_color_brightness(HIGHLIGHT_COLOR, -20)
+        )
+        lossless_png_checkbox.grid(row=0, column=4, padx=(20, 0))
+
         # Create preview frame with scrollbar
         preview_container = ctk.CTkFrame(self, fg_color="transparent")
         preview_container.grid(row=1, column=0, sticky="nsew", padx=20, pady=(0, 20))
@@ -455,7 +706,12 @@ class OptiWebpGUI(ctk.CTk):
         )
         scrollbar.grid(row=0, column=1, sticky="ns")
 
-        self.preview_canvas.configure(yscrollcommand=scrollbar.set)
+        def on_preview_scroll(first, last):
+            scrollbar.set(first, last)
+            # Materialize the cells that just scrolled into view
+            self.schedule_visible_previews()
+
+        self.preview_canvas.configure(yscrollcommand=on_preview_scroll)
 
         # Create frame inside canvas for image previews
         self.preview_frame = ctk.CTkFrame(self.preview_canvas, fg_color="transparent")
@@ -482,6 +738,13 @@ class OptiWebpGUI(ctk.CTk):
         self.progress_bar.set(0)
         self.progress_bar.configure(progress_color=HIGHLIGHT_COLOR)
         
+        self.log_textbox = ctk.CTkTextbox(self.progress_frame, height=110, wrap="none")
+        self.log_textbox.grid(row=2, column=0, padx=20, pady=(0, 10), sticky="ew")
+        self.log_textbox.configure(state="disabled")
+        
+        # Repaint progress and the log at a fixed rate instead of per update
+        self.after(1000 // PROGRESS_FPS, self.refresh_progress)
+        
         # Delete original files option (moved to bottom)
         delete_frame = ctk.CTkFrame(self, fg_color="transparent")
         delete_frame.grid(row=3, column=0, padx=20, pady=(0, 10), sticky="ew")
@@ -520,6 +783,9 @@ class OptiWebpGUI(ctk.CTk):
         self.preview_canvas.bind_all("<MouseWheel>", self._on_mousewheel)
         self.preview_canvas.bind("<Enter>", self._bind_mousewheel)
         self.preview_canvas.bind("<Leave>", self._unbind_mousewheel)
+
+        # Hand background scan/thumbnail results to the UI in batches
+        self.after(40, self.drain_preview_results)
     
     def adjust_color_brightness(self, color_hex, brightness_offset=0):
         """Adjust the brightness of a hex color"""
@@ -596,7 +862,7 @@ class OptiWebpGUI(ctk.CTk):
         )
         
         # If showing placeholder, recreate it with new dimensions
-        if not self.preview_images:
+        if not self.preview_paths:
             self.create_placeholder()
         else:
             self.update_preview_grid(event.width)
@@ -683,66 +949,170 @@ class OptiWebpGUI(ctk.CTk):
 
     def clear_preview_images(self):
         """Clear all preview images"""
+        # Results still in flight for the old folder are ignored from now on
+        self.preview_generation += 1
         for widget in self.preview_frame.winfo_children():
             widget.destroy()
-        self.preview_images.clear()
-        
-        # Show placeholder
+        self.preview_paths = []
+        self.preview_labels.clear()
+        self.preview_pending.clear()
+        self.preview_failed.clear()
+        self.preview_visible = (0, -1)
+        
+        # Let the frame size itself again and show the placeholder
+        self.preview_canvas.itemconfig(self.preview_canvas_window, height=0)
+        self.preview_canvas.yview_moveto(0)
         self.create_placeholder()
 
-    def create_thumbnail(self, image_path):
-        """Create a thumbnail from an image file"""
+    def render_thumbnail(self, image_path):
+        """Decode and resize an image into a thumbnail (cache miss path)"""
         try:
             with Image.open(image_path) as img:
+                # Decode at reduced scale where the format allows it (JPEG DCT
+                # scaling), then shrink in place keeping the aspect ratio
+                img.thumbnail((self.thumbnail_size, self.thumbnail_size), Image.Resampling.LANCZOS, reducing_gap=2.0)
+                
                 # Convert RGBA to RGB if necessary
                 if img.mode == 'RGBA':
                     img = img.convert('RGB')
-                
-                # Calculate thumbnail size maintaining aspect ratio
-                width, height = img.size
-                aspect_ratio = width / height
-                
-                if aspect_ratio > 1:
-                    new_width = self.thumbnail_size
-                    new_height = int(self.thumbnail_size / aspect_ratio)
-                else:
-                    new_height = self.thumbnail_size
-                    new_width = int(self.thumbnail_size * aspect_ratio)
-                
-                # Resize with high-quality resampling
-                img = img.resize((new_width, new_height), Image.Resampling.LANCZOS)
-                ctk_image = CTkImage(light_image=img, size=(new_width, new_height))
-                return ctk_image
+                return img
         except Exception as e:
             print(f"Error creating thumbnail for {image_path}: {e}")
             return None
 
-    def update_preview_grid(self, container_width):
-        """Update the preview grid layout"""
-        if not self.preview_images:
+    def load_preview_thumbnail(self, generation, index, image_path):
+        """Background worker: fetch one thumbnail and queue it for the Tk thread"""
+        first, last = self.preview_visible
+        if generation != self.preview_generation or not (first <= index <= last):
+            # Folder changed or the cell scrolled away before we got to it
+            self.preview_results.put(("thumbnail", generation, index, None, False))
             return
+        try:
+            img = self.thumbnail_cache.get_or_create(image_path, self.thumbnail_size, self.render_thumbnail)
+        except Exception as e:
+            print(f"Error creating thumbnail for {image_path}: {e}")
+            img = None
+        self.preview_results.put(("thumbnail", generation, index, img, img is None))
+
+    def scan_preview_directory(self, generation, directory, include_subdirs):
+        """Background worker: stream the folder's image paths to the Tk thread in batches"""
+        batch = []
+        for item in opti_webp.scan_images(directory, include_subdirs):
+            if generation != self.preview_generation:
+                return
+            batch.append(item.path)
+            if len(batch) >= 500:
+                self.preview_results.put(("paths", generation, batch))
+                batch = []
+        if batch:
+            self.preview_results.put(("paths", generation, batch))
+
+    def drain_preview_results(self):
+        """Apply a batch of background results on the Tk thread, then reschedule"""
+        layout_changed = False
+        new_thumbnails = []
+        try:
+            for _ in range(200):
+                message = self.preview_results.get_nowait()
+                if message[1] != self.preview_generation:
+                    continue
+                if message[0] == "paths":
+                    if not self.preview_paths:
+                        # First images found: remove the placeholder
+                        for widget in self.preview_frame.winfo_children():
+                            widget.destroy()
+                    self.preview_paths.extend(message[2])
+                    layout_changed = True
+                else:
+                    _, _, index, img, failed = message
+                    self.preview_pending.discard(index)
+                    if failed:
+                        self.preview_failed.add(index)
+                    elif img is not None:
+                        new_thumbnails.append((index, img))
+        except queue.Empty:
+            pass
+        
+        if layout_changed:
+            self.update_preview_grid(self.preview_canvas.winfo_width())
+        if new_thumbnails:
+            columns, cell_width, row_height = self.preview_layout()
+            first, last = self.preview_visible
+            for index, img in new_thumbnails:
+                if first <= index <= last and index not in self.preview_labels:
+                    ctk_image = CTkImage(light_image=img, size=img.size)
+                    label = ctk.CTkLabel(self.preview_frame, image=ctk_image, text="")
+                    label.image = ctk_image  # Prevent garbage collection
+                    self.preview_labels[index] = label
+                    self.place_preview_label(index, label, columns, cell_width, row_height)
+        
+        self.after(40, self.drain_preview_results)
 
-        # Calculate optimal thumbnail size based on container width
+    def preview_layout(self):
+        """Return (columns, cell width, row height) of the preview grid"""
         padding = 10
         min_columns = 3  # Minimum number of columns
         max_columns = 6  # Maximum number of columns
         
         # Calculate the optimal number of columns
-        available_width = container_width - (padding * 2)
+        available_width = max(1, self.preview_canvas.winfo_width() - (padding * 2))
         optimal_columns = min(max_columns, max(min_columns, available_width // (self.thumbnail_size + padding)))
+        return optimal_columns, available_width // optimal_columns, self.thumbnail_size + padding
+
+    def place_preview_label(self, index, label, columns, cell_width, row_height):
+        padding = 10
+        row = index // columns
+        col = index % columns
+        label.place(x=padding + col * cell_width + cell_width // 2, y=row * row_height + padding // 2, anchor="n")
+
+    def update_preview_grid(self, container_width):
+        """Size the virtual grid for every previewed image and refresh the cells in view"""
+        if not self.preview_paths:
+            return
+
+        columns, cell_width, row_height = self.preview_layout()
+        rows = (len(self.preview_paths) + columns - 1) // columns
+        
+        # The frame is as tall as the whole grid so the scrollbar is right,
+        # even though only the visible rows have widgets
+        self.preview_canvas.itemconfig(self.preview_canvas_window, height=rows * row_height + 10)
+        for index, label in self.preview_labels.items():
+            self.place_preview_label(index, label, columns, cell_width, row_height)
+        self.schedule_visible_previews()
+
+    def schedule_visible_previews(self):
+        """Coalesce visibility updates (scrolling fires many) into one idle callback"""
+        if not self.preview_update_scheduled:
+            self.preview_update_scheduled = True
+            self.after_idle(self.update_visible_previews)
+
+    def update_visible_previews(self):
+        """Materialize the rows in view, release the rest and queue missing thumbnails"""
+        self.preview_update_scheduled = False
+        if not self.preview_paths:
+            return
         
-        # Calculate the actual thumbnail size to use
-        actual_thumbnail_size = (available_width // optimal_columns) - padding
-        
-        # Reconfigure grid
-        for i in range(optimal_columns):
-            self.preview_frame.grid_columnconfigure(i, weight=1)
-        
-        # Rearrange images
-        for idx, (label, _) in enumerate(self.preview_images):
-            row = idx // optimal_columns
-            col = idx % optimal_columns
-            label.grid(row=row, column=col, padx=padding//2, pady=padding//2)
+        columns, cell_width, row_height = self.preview_layout()
+        top = self.preview_canvas.canvasy(0)
+        bottom = top + self.preview_canvas.winfo_height()
+        # Keep one extra row above and below so scrolling doesn't show gaps
+        first_row = max(0, int(top // row_height) - 1)
+        last_row = int(bottom // row_height) + 1
+        first = first_row * columns
+        last = min(len(self.preview_paths), (last_row + 1) * columns) - 1
+        self.preview_visible = (first, last)
+        
+        # Release widgets (and their images) that scrolled out of view
+        for index in [index for index in self.preview_labels if index < first or index > last]:
+            self.preview_labels.pop(index).destroy()
+        
+        # Decode what's missing on the worker pool, nearest rows first
+        for index in range(first, last + 1):
+            if index in self.preview_labels or index in self.preview_pending or index in self.preview_failed:
+                continue
+            self.preview_pending.add(index)
+            self.thumbnail_executor.submit(self.load_preview_thumbnail, self.preview_generation,
+                                           index, self.preview_paths[index])
 
     def update_preview_for_directory(self, directory=None):
         """Update the preview images for the given or currently selected directory"""
@@ -754,38 +1124,13 @@ class OptiWebpGUI(ctk.CTk):
             
         self.clear_preview_images()
         
-        # Get list of image files
-        image_files = []
-        extensions = ('*.jpg', '*.jpeg', '*.png', '*.gif', '*.bmp', '*.heic', '*.tiff', '*.tif')
-        
-        if self.include_subdirectories.get():
-            # Include all subdirectories
-            for ext in extensions:
-                image_files.extend(glob.glob(os.path.join(directory, "**", ext), recursive=True))
-        else:
-            # Only include files in the top directory
-            for ext in extensions:
-                image_files.extend(glob.glob(os.path.join(directory, ext)))
-        
-        # Count total images
-        self.total_images = len(image_files)
-        
-        if self.total_images > 0:
-            # Clear placeholder if it exists
-            for widget in self.preview_frame.winfo_children():
-                widget.destroy()
-            
-            # Create thumbnails for preview
-            for image_path in image_files:
-                ctk_image = self.create_thumbnail(image_path)
-                if ctk_image:
-                    label = ctk.CTkLabel(self.preview_frame, image=ctk_image, text="")
-                    label.image = ctk_image  # Prevent garbage collection
-                    self.preview_images.append((label, image_path))
-            
-            # Update grid layout
-            if self.preview_images:
-                self.update_preview_grid(self.preview_canvas.winfo_width())
+        # Scan in the background (same scanner and extension rules as the backend);
+        # paths arrive in batches and thumbnails load only for the rows in view
+        threading.Thread(
+            target=self.scan_preview_directory,
+            args=(self.preview_generation, directory, self.include_subdirectories.get()),
+            daemon=True
+        ).start()
 
     def browse_directory(self):
         directory = filedialog.askdirectory()
@@ -805,20 +1150,51 @@ class OptiWebpGUI(ctk.CTk):
             self.preserve_structure_checkbox.configure(state="disabled")
 
     def log(self, message):
-        self.log_text += message + "\n"
+        """Queue a log line; safe to call from any thread"""
+        self.log_queue.put(message)
+    
+    def log_event(self, event):
+        """Event sink for the backend: log the same lines the console gets"""
+        message = opti_webp.format_event(event)
+        if message:
+            self.log(message)
+    
+    def flush_log(self):
+        """Append queued lines to the log box, keeping at most LOG_MAX_LINES"""
+        new_lines = []
+        try:
+            while True:
+                new_lines.append(self.log_queue.get_nowait())
+        except queue.Empty:
+            pass
+        if not new_lines:
+            return
+        
+        # Only the newest lines can be visible, so a huge burst is trimmed up front
+        new_lines = new_lines[-LOG_MAX_LINES:]
         self.log_textbox.configure(state="normal")
-        self.log_textbox.delete("1.0", "end")
-        self.log_textbox.insert("1.0", self.log_text)
+        self.log_textbox.insert("end", "\n".join(new_lines) + "\n")
+        # Drop the oldest lines so the box never holds more than LOG_MAX_LINES
+        line_count = int(self.log_textbox.index("end-1c").split(".")[0]) - 1
+        if line_count > LOG_MAX_LINES:
+            self.log_textbox.delete("1.0", f"{line_count - LOG_MAX_LINES + 1}.0")
         self.log_textbox.configure(state="disabled")
         self.log_textbox.see("end")
-        self.update_idletasks()
     
     def update_progress(self, increment=1):
         self.processed_images += increment
         if self.total_images > 0:
-            progress = self.processed_images / self.total_images
+            self.progress_fraction = self.processed_images / self.total_images
+    
+    def refresh_progress(self):
+        """Paint the latest progress and log lines, then reschedule (runs on the Tk thread)"""
+        progress = min(1.0, self.progress_fraction)
+        if progress != self.shown_progress:
+            self.shown_progress = progress
             self.progress_bar.set(progress)
             self.progress_label.configure(text=f"Progress: {int(progress * 100)}%")
+        self.flush_log()
+        self.after(1000 // PROGRESS_FPS, self.refresh_progress)
     
     def process_images(self):
         if not self.selected_directory.get():
@@ -855,10 +1231,6 @@ class OptiWebpGUI(ctk.CTk):
             return
         
         include_subdirectories = self.include_subdirectories.get()
-        image_count = opti_webp.count_images(directory, include_subdirectories)
-        if image_count == 0:
-            custom_showinfo(self, "Info", "No optimizable images found in the selected directory.")
-            return
         
         # Confirm deletion if enabled
         if delete_original:
@@ -866,11 +1238,10 @@ class OptiWebpGUI(ctk.CTk):
             if not confirm:
                 return
         
-        # Reset progress
-        self.total_images = image_count
+        # Reset progress; the total grows as the backend's scan finds images
+        self.total_images = 0
         self.processed_images = 0
-        self.progress_bar.set(0)
-        self.progress_label.configure(text="Progress: 0%")
+        self.progress_fraction = 0.0
         
         # Start processing in a separate thread
         self.processing = True
@@ -886,11 +1257,11 @@ class OptiWebpGUI(ctk.CTk):
                     # Calculate overall progress
                     # For incomplete images, add the step progress
                     # step_progress is between 0-1 for the current image
-                    total_progress = (self.processed_images + (0 if step_progress == 1.0 else step_progress)) / self.total_images
-                    self.progress_bar.set(total_progress)
-                    self.progress_label.configure(text=f"Progress: {int(total_progress * 100)}%")
-                    # Force the GUI to update
-                    self.update_idletasks()
+                    # Only record it: the Tk thread repaints at PROGRESS_FPS
+                    self.progress_fraction = (self.processed_images + (0 if step_progress == 1.0 else step_progress)) / max(1, self.total_images)
+
+                def update_total(found_count):
+                    self.total_images = found_count
 
                 # Get preserve structure value for passing to resize_and_convert
                 preserve_structure = self.preserve_structure.get()
@@ -899,6 +1270,12 @@ class OptiWebpGUI(ctk.CTk):
                     preserve_structure = True  # Default to True in other cases
 
                 preserve_exif = self.preserve_exif.get()
+                workers = int(self.workers.get())
+                incremental = self.incremental.get()
+                dedup = self.dedup.get()
+                journal = self.journal.get()
+                overrides = {"PNG": {"lossless": True}} if self.lossless_png.get() else None
+                encoder = opti_webp.EncoderOptions.from_profile(self.encoder_profile.get(), overrides=overrides)
 
                 opti_webp.resize_and_convert(
                     directory, 
@@ -910,12 +1287,23 @@ class OptiWebpGUI(ctk.CTk):
                     output_path,  # custom_output_dir parameter
                     preserve_structure,  # preserve_structure parameter
                     update_progress,  # progress_callback parameter
-                    preserve_exif  # NEW: pass preserve_exif to backend
+                    preserve_exif,  # NEW: pass preserve_exif to backend
+                    workers,  # number of worker processes
+                    incremental=incremental,
+                    scan_callback=update_total,
+                    dedup=dedup,
+                    encoder=encoder,
+                    events=[opti_webp.ConsoleSink(), self.log_event],
+                    journal=journal,
+                    resume=journal
                 )
                 
+                if self.total_images == 0:
+                    custom_showinfo(self, "Info", "No optimizable images found in the selected directory.")
+                    return
+                
                 # Ensure progress is at 100% when done
-                self.progress_bar.set(1.0)
-                self.progress_label.configure(text="Progress: 100%")
+                self.progress_fraction = 1.0
                 
                 custom_showinfo(self, "Success", "Processing completed successfully!")
             except Exception as e:
@@ -1008,5 +1396,7 @@ class OptiWebpGUI(ctk.CTk):
             self.output_directory.set(self.selected_directory.get())
 
 if __name__ == "__main__":
+    # Needed for the process pool in frozen (PyInstaller) builds
+    multiprocessing.freeze_support()
     app = OptiWebpGUI()
     app.mainloop() 
\ No newline at end of file
@@ -0,0 +1,342 @@
+import os
+import sys
+import json
+import hashlib
+import argparse
+import threading
+from collections import OrderedDict
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, unquote, parse_qs
+from PIL import UnidentifiedImageError
+import opti_webp
+
+# Largest width or height a request may ask for
+MAX_DIMENSION = 16384
+
+# How long clients may reuse a response without revalidating
+CACHE_MAX_AGE = 3600
+
+class VariantCache:
+    """A size-bounded LRU cache of encoded variants, in memory and optionally on disk.
+
+    The memory tier holds up to max_bytes of WebP data. With directory set,
+    every variant is also written there as <key>.webp (up to max_disk_bytes,
+    least recently used first out), so the cache survives restarts and
+    variants evicted from memory are read back instead of re-encoded.
+    """
+
+    def __init__(self, max_bytes, directory=None, max_disk_bytes=None):
+        self.max_bytes = max_bytes
+        self.directory = directory
+        self.max_disk_bytes = max_disk_bytes
+        self._lock = threading.Lock()
+        self._memory = OrderedDict()
+        self._memory_bytes = 0
+        self._disk = OrderedDict()
+        self._disk_bytes = 0
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+            # Rebuild the disk index oldest first; hits refresh a file's mtime
+            entries = []
+            with os.scandir(directory) as listing:
+                for entry in listing:
+                    if entry.name.endswith(".webp") and entry.is_file():
+                        stat = entry.stat()
+                        entries.append((stat.st_mtime_ns, entry.name[:-5], stat.st_size))
+            for _, key, size in sorted(entries):
+                self._disk[key] = size
+                self._disk_bytes += size
+            self._evict_disk()
+
+    def _disk_path(self, key):
+        return os.path.join(self.directory, key + ".webp")
+
+    def get(self, key):
+        """Return (data, "memory" or "disk") for a cached variant, or (None, None)."""
+        with self._lock:
+            data = self._memory.get(key)
+            if data is not None:
+                self._memory.move_to_end(key)
+                return data, "memory"
+            on_disk = key in self._disk
+            if on_disk:
+                self._disk.move_to_end(key)
+        if not on_disk:
+            return None, None
+        try:
+            with open(self._disk_path(key), "rb") as f:
+                data = f.read()
+            os.utime(self._disk_path(key))
+        except OSError:
+            # Removed behind our back; forget it
+            with self._lock:
+                self._disk_bytes -= self._disk.pop(key, 0)
+            return None, None
+        self._put_memory(key, data)
+        return data, "disk"
+
+    def put(self, key, data):
+        self._put_memory(key, data)
+        if self.directory:
+            with opti_webp.atomic_open(self._disk_path(key)) as f:
+                f.write(data)
+            with self._lock:
+                self._disk_bytes += len(data) - self._disk.pop(key, 0)
+                self._disk[key] = len(data)
+                self._evict_disk()
+
+    def _put_memory(self, key, data):
+        if len(data) > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._memory:
+                self._memory_bytes -= len(self._memory.pop(key))
+            self._memory[key] = data
+            self._memory_bytes += len(data)
+            while self._memory_bytes > self.max_bytes:
+                _, evicted = self._memory.popitem(last=False)
+                self._memory_bytes -= len(evicted)
+
+    def _evict_disk(self):
+        # Called with the lock held
+        while self.max_disk_bytes is not None and self._disk_bytes > self.max_disk_bytes and self._disk:
+            key, size = self._disk.popitem(last=False)
+            self._disk_bytes -= size
+            try:
+                os.remove(self._disk_path(key))
+            except OSError:
+                pass
+
+    def stats(self):
+        with self._lock:
+            return {"memory_entries": len(self._memory), "memory_bytes": self._memory_bytes,
+                    "disk_entries": len(self._disk), "disk_bytes": self._disk_bytes}
+
+class SingleFlight:
+    """Coalesces concurrent calls with the same key into one call of the function."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, function):
+        """Return function()'s result (or raise its error); returns (result, True if this call ran it)."""
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = {"done": threading.Event()}
+        if not leader:
+            call["done"].wait()
+            if "error" in call:
+                raise call["error"]
+            return call["result"], False
+        try:
+            call["result"] = function()
+            return call["result"], True
+        except BaseException as e:
+            call["error"] = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call["done"].set()
+
+class ConversionServer(ThreadingHTTPServer):
+    """Serves /<path>?w=&h=&q= as WebP conversions of the images under root.
+
+    widths, heights and qualities are allowlists. Once any is given, the
+    server is restricted: a parameter must be on its list, and parameters
+    with no list are refused, so requests can't create unbounded variants.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, address, root, cache, encoder=None, max_width=None, max_height=None, widths=None,
+                 max_encodes=None, events=None, heights=None, qualities=None):
+        super().__init__(address, ConversionHandler)
+        self.root = os.path.realpath(root)
+        self.cache = cache
+        self.encoder = opti_webp.resolve_encoder(encoder)
+        # A pipe to the client must carry an image, so the size guard can't skip
+        if self.encoder.size_guard == "skip":
+            self.encoder = self.encoder.replace(size_guard="smallest")
+        self.max_width = max_width
+        self.max_height = max_height
+        self.allowed = {"w": widths, "h": heights, "q": qualities}
+        self.allowed = {name: set(values) for name, values in self.allowed.items() if values}
+        self.events = events
+        self.flights = SingleFlight()
+        # Bounds the decoded images held at once, like the pool's worker count
+        self.encode_slots = threading.BoundedSemaphore(max_encodes or os.cpu_count() or 1)
+        self.counters = {"requests": 0, "hits": 0, "misses": 0, "coalesced": 0, "not_modified": 0}
+        self._counter_lock = threading.Lock()
+
+    def count(self, name):
+        with self._counter_lock:
+            self.counters[name] += 1
+
+    def resolve_source(self, url_path):
+        """Map a URL path to an image under root, or None if there is no such image."""
+        rel_path = unquote(url_path).lstrip("/")
+        path = os.path.realpath(os.path.join(self.root, *rel_path.split("/")))
+        # realpath resolves .. and symlinks, so anything outside root is refused
+        if not path.startswith(self.root + os.sep):
+            return None
+        if not path.lower().endswith(opti_webp.IMAGE_EXTENSIONS) or not os.path.isfile(path):
+            return None
+        return path
+
+    def variant_params(self, query):
+        """Parse w, h and q into a dict, raising ValueError for bad values."""
+        fields = parse_qs(query)
+        params = {}
+        for name in ("w", "h", "q"):
+            if name in fields:
+                value = int(fields[name][-1])
+                limit = 100 if name == "q" else MAX_DIMENSION
+                if not (0 <= value <= limit if name == "q" else 0 < value <= limit):
+                    raise ValueError(f"{name} must be between {0 if name == 'q' else 1} and {limit}")
+                params[name] = value
+        if self.allowed:
+            for name, value in params.items():
+                if name not in self.allowed:
+                    raise ValueError(f"{name} is not accepted by this server")
+                if value not in self.allowed[name]:
+                    raise ValueError(f"{name} must be one of {', '.join(str(v) for v in sorted(self.allowed[name]))}")
+        # Server-wide limits cap what a request may ask for
+        for name, limit in (("w", self.max_width), ("h", self.max_height)):
+            if limit and params.get(name, limit) >= limit:
+                params[name] = limit
+        return params
+
+    def variant_key(self, path, params):
+        """Cache key and ETag: the source's identity plus everything that shapes the output."""
+        stat = os.stat(path)
+        identity = [os.path.relpath(path, self.root).replace(os.sep, "/"), stat.st_size, stat.st_mtime_ns,
+                    params, self.encoder.to_dict()]
+        return hashlib.sha256(json.dumps(identity, sort_keys=True).encode("utf-8")).hexdigest()[:32]
+
+    def convert(self, path, params):
+        encoder = self.encoder
+        if "q" in params:
+            encoder = encoder.replace(quality=params["q"])
+        with self.encode_slots:
+            with open(path, "rb") as f:
+                result = opti_webp.convert_bytes(f, params.get("w"), params.get("h"), encoder,
+                                                 events=self.events, label=path)
+        return result.data
+
+class ConversionHandler(BaseHTTPRequestHandler):
+    server_version = "OptiWebP"
+
+    def do_HEAD(self):
+        self.do_GET(head=True)
+
+    def do_GET(self, head=False):
+        server = self.server
+        server.count("requests")
+        url = urlsplit(self.path)
+        if url.path == "/_stats":
+            body = json.dumps(dict(server.counters, **server.cache.stats())).encode("utf-8")
+            return self.respond(HTTPStatus.OK, body, "application/json", head=head)
+
+        path = server.resolve_source(url.path)
+        if path is None:
+            return self.respond_error(HTTPStatus.NOT_FOUND, "No such image", head)
+        try:
+            params = server.variant_params(url.query)
+        except ValueError as e:
+            return self.respond_error(HTTPStatus.BAD_REQUEST, str(e), head)
+        try:
+            key = server.variant_key(path, params)
+        except OSError:
+            return self.respond_error(HTTPStatus.NOT_FOUND, "No such image", head)
+        etag = f'"{key}"'
+
+        # The key is known before encoding, so revalidation never costs an encode
+        if self.etag_matches(etag):
+            server.count("not_modified")
+            return self.respond(HTTPStatus.NOT_MODIFIED, b"", etag=etag, head=True)
+
+        data, tier = server.cache.get(key)
+        if data is not None:
+            server.count("hits")
+        else:
+            def encode():
+                data = server.convert(path, params)
+                server.cache.put(key, data)
+                return data
+            try:
+                data, leader = server.flights.do(key, encode)
+            except UnidentifiedImageError:
+                return self.respond_error(HTTPStatus.UNSUPPORTED_MEDIA_TYPE, "Not a readable image", head)
+            except Exception as e:
+                self.log_error("Conversion failed for %s: %s", path, e)
+                return self.respond_error(HTTPStatus.INTERNAL_SERVER_ERROR, "Conversion failed", head)
+            server.count("misses" if leader else "coalesced")
+            tier = "miss" if leader else "coalesced"
+        self.respond(HTTPStatus.OK, data, "image/webp", etag, tier, head)
+
+    def etag_matches(self, etag):
+        header = self.headers.get("If-None-Match")
+        if not header:
+            return False
+        # Weak comparison, as RFC 9110 asks for If-None-Match
+        tags = [tag.strip() for tag in header.split(",")]
+        return any(tag == "*" or (tag[2:] if tag.startswith("W/") else tag) == etag for tag in tags)
+
+    def respond(self, status, body, content_type=None, etag=None, cache=None, head=False):
+        self.send_response(status)
+        if content_type:
+            self.send_header("Content-Type", content_type)
+        if etag:
+            self.send_header("ETag", etag)
+            self.send_header("Cache-Control", f"public, max-age={CACHE_MAX_AGE}")
+        if cache:
+            self.send_header("X-Cache", cache)
+        if status != HTTPStatus.NOT_MODIFIED:
+            self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if not head:
+            self.wfile.write(body)
+
+    def respond_error(self, status, message, head=False):
+        self.respond(status, (message + "\n").encode("utf-8"), "text/plain; charset=utf-8", head=head)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Serve WebP conversions of a folder's images on demand, "
+                                                 "e.g. http://127.0.0.1:8000/photos/cat.jpg?w=800")
+    parser.add_argument("root", help="folder to serve images from")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--profile", default="balanced", choices=list(opti_webp.EncoderOptions.PROFILES))
+    parser.add_argument("--max-width", type=int, help="largest width served (also the default)")
+    parser.add_argument("--max-height", type=int, help="largest height served (also the default)")
+    parser.add_argument("--widths", type=int, nargs="+", metavar="WIDTH", help="only serve these widths")
+    parser.add_argument("--heights", type=int, nargs="+", metavar="HEIGHT", help="only serve these heights")
+    parser.add_argument("--qualities", type=int, nargs="+", metavar="Q", help="only serve these qualities")
+    parser.add_argument("--cache-mb", type=int, default=256, help="memory cache size")
+    parser.add_argument("--cache-dir", help="also keep variants on disk here")
+    parser.add_argument("--disk-cache-mb", type=int, default=4096, help="disk cache size")
+    parser.add_argument("--max-encodes", type=int, help="concurrent encodes (default: one per CPU)")
+    parser.add_argument("-v", "--verbose", action="store_true", help="log conversion events")
+    args = parser.parse_args(argv)
+
+    cache = VariantCache(args.cache_mb * 1024 ** 2, args.cache_dir, args.disk_cache_mb * 1024 ** 2)
+    server = ConversionServer((args.host, args.port), args.root, cache, args.profile, args.max_width,
+                              args.max_height, args.widths, args.max_encodes,
+                              opti_webp.ConsoleSink(sys.stderr) if args.verbose else None, args.heights,
+                              args.qualities)
+    print(f"Serving WebP conversions of {server.root} on http://{args.host}:{server.server_address[1]}/",
+          file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+if __name__ == "__main__":
+    sys.exit(main())